@@ -0,0 +1,307 @@
+import bisect
+import functools
+import json
+import mmap
+import sys
+from array import array
+import rdflib
+from rdflib.store import Store
+
+"""
+This file figures a read-only rdflib store, meant for the graphs the converter only reads once they are loaded.
+Every term is interned once into an integer id, and the triples are kept as three sorted permutations (SPO, POS, OSP) of id columns stored in arrays.
+Any triple pattern is then answered by a binary search in the right permutation, which is all rdflib needs to serve
+Resource methods (value, subjects, predicate_objects, ...) and SPARQL queries on top of it.
+
+The same structure can be written to disk (dump_compact) as a sorted term dictionary followed by the id columns, in the spirit of HDT.
+MappedCompactStore queries such a file through mmap: terms are decoded only when a query returns them,
+and several processes reading the same file share the OS page cache.
+"""
+
+# Column order of each permutation, as positions in the (subject, predicate, object) triple
+PERMUTATIONS = {"spo": (0, 1, 2), "pos": (1, 2, 0), "osp": (2, 0, 1)}
+ID_TYPECODE = "I"
+OFFSET_TYPECODE = "Q"
+FILE_MAGIC = b"RDFC1" + sys.byteorder[0].encode() + bytes([array(ID_TYPECODE).itemsize, 0])
+TERM_CACHE_SIZE = 100000
+
+
+class CompactStore(Store):
+    """
+    Read-only rdflib store holding integer-interned triples in sorted arrays.
+    Wrap it in a graph with rdflib.Graph(store=CompactStore(triples, namespaces)), or use compact_graph.
+    """
+
+    def __init__(self, triples=(), namespaces=()):
+        super().__init__()
+        self._namespace = {}
+        self._prefix = {}
+        self.terms = []
+        self.ids = {}
+        rows = set()
+        for s, p, o in triples:
+            rows.add((self.intern(s), self.intern(p), self.intern(o)))
+        if len(self.terms) >= 2 ** (8 * array(ID_TYPECODE).itemsize):
+            raise Exception("Too many distinct terms for a CompactStore")
+        self.length = len(rows)
+        self.indexes = {
+            name: self.build_index(rows, order) for name, order in PERMUTATIONS.items()
+        }
+        for prefix, namespace in namespaces:
+            self.bind(prefix, namespace)
+
+    def intern(self, term):
+        """
+        Return the id of the term, registering it if it is new.
+        """
+        tid = self.ids.get(term)
+        if tid is None:
+            tid = len(self.terms)
+            self.ids[term] = tid
+            self.terms.append(term)
+        return tid
+
+    def term_id(self, term):
+        return self.ids.get(term)
+
+    def term(self, tid):
+        return self.terms[tid]
+
+    @staticmethod
+    def build_index(rows, order):
+        """
+        Sort the id triples along the given column order and store each column in its own array.
+        """
+        permuted = sorted(tuple(row[k] for k in order) for row in rows)
+        return tuple(array(ID_TYPECODE, [row[k] for row in permuted]) for k in range(3))
+
+    def match(self, triple_pattern):
+        """
+        Yield the (subject, predicate, object) id triples matching a pattern of ids, None standing for a wildcard.
+        """
+        s, p, o = triple_pattern
+        if s is not None and p is not None:
+            name, prefix = "spo", (s, p) if o is None else (s, p, o)
+        elif s is not None and o is not None:
+            name, prefix = "osp", (o, s)
+        elif s is not None:
+            name, prefix = "spo", (s,)
+        elif p is not None:
+            name, prefix = "pos", (p,) if o is None else (p, o)
+        elif o is not None:
+            name, prefix = "osp", (o,)
+        else:
+            name, prefix = "spo", ()
+        columns = self.indexes[name]
+        lo, hi = 0, self.length
+        for col, val in zip(columns, prefix):
+            lo = bisect.bisect_left(col, val, lo, hi)
+            hi = bisect.bisect_right(col, val, lo, hi)
+        order = PERMUTATIONS[name]
+        first, second, third = columns
+        for i in range(lo, hi):
+            row = [0, 0, 0]
+            row[order[0]], row[order[1]], row[order[2]] = first[i], second[i], third[i]
+            yield row
+
+    def triples(self, triple_pattern, context=None):
+        ids = []
+        for term in triple_pattern:
+            if term is None:
+                ids.append(None)
+                continue
+            tid = self.term_id(term)
+            if tid is None:
+                # A term absent from the store cannot match anything
+                return
+            ids.append(tid)
+        term = self.term
+        for s, p, o in self.match(ids):
+            yield (term(s), term(p), term(o)), iter(())
+
+    def __len__(self, context=None):
+        return self.length
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    def add(self, triple, context=None, quoted=False):
+        raise Exception("CompactStore is read-only")
+
+    def addN(self, quads):
+        raise Exception("CompactStore is read-only")
+
+    def remove(self, triple, context=None):
+        raise Exception("CompactStore is read-only")
+
+    def bind(self, prefix, namespace, override=True):
+        """
+        Same prefix/namespace bookkeeping as rdflib's default Memory store.
+        """
+        bound_namespace = self._namespace.get(prefix)
+        bound_prefix = self._prefix.get(namespace)
+        if bound_prefix is None:
+            bound_prefix = self._prefix.get(bound_namespace)
+        if override:
+            if bound_prefix is not None:
+                del self._namespace[bound_prefix]
+            if bound_namespace is not None:
+                del self._prefix[bound_namespace]
+            self._prefix[namespace] = prefix
+            self._namespace[prefix] = namespace
+        else:
+            new_namespace = namespace if bound_namespace is None else bound_namespace
+            new_prefix = prefix if bound_prefix is None else bound_prefix
+            self._prefix[new_namespace] = new_prefix
+            self._namespace[new_prefix] = new_namespace
+
+    def namespace(self, prefix):
+        return self._namespace.get(prefix, None)
+
+    def prefix(self, namespace):
+        return self._prefix.get(namespace, None)
+
+    def namespaces(self):
+        for prefix, namespace in list(self._namespace.items()):
+            yield prefix, namespace
+
+
+def compact_graph(graph):
+    """
+    Return a read-only copy of the graph backed by a CompactStore, with the same identifier and namespace bindings.
+    """
+    store = CompactStore(graph, graph.namespaces())
+    return rdflib.Graph(store=store, identifier=graph.identifier)
+
+
+def encode_term(term):
+    """
+    Serialize a term as bytes. Literals put their lexical form last so it may contain any character.
+    """
+    if isinstance(term, rdflib.Literal):
+        return b"\x00".join(
+            [
+                b"L" + (term.language or "").encode(),
+                (term.datatype or "").encode(),
+                str(term).encode(),
+            ]
+        )
+    if isinstance(term, rdflib.BNode):
+        return b"B" + str(term).encode()
+    return b"U" + str(term).encode()
+
+
+def decode_term(raw):
+    kind = raw[:1]
+    if kind == b"U":
+        return rdflib.URIRef(raw[1:].decode())
+    if kind == b"B":
+        return rdflib.BNode(raw[1:].decode())
+    lang, datatype, lexical = raw[1:].split(b"\x00", 2)
+    return rdflib.Literal(
+        lexical.decode(),
+        lang=lang.decode() or None,
+        datatype=rdflib.URIRef(datatype.decode()) if datatype else None,
+    )
+
+
+def padding(size):
+    return b"\x00" * (-size % 8)
+
+
+def dump_compact(graph, path):
+    """
+    Write the graph to a compact file readable by MappedCompactStore.
+    Layout: magic, counts, term offsets, sorted term dictionary, namespaces (json), then the nine id columns of the spo, pos and osp permutations.
+    Term ids are the ranks of the encoded terms in the dictionary, so a term is found back by binary search.
+    """
+    encoded = sorted(set(encode_term(k) for triple in graph for k in triple))
+    ranks = {raw: rank for rank, raw in enumerate(encoded)}
+    rows = set(
+        tuple(ranks[encode_term(k)] for k in triple) for triple in graph
+    )
+    offsets = array(OFFSET_TYPECODE, [0])
+    for raw in encoded:
+        offsets.append(offsets[-1] + len(raw))
+    blob = b"".join(encoded)
+    namespaces = json.dumps([[p, str(n)] for p, n in graph.namespaces()]).encode()
+    header = array(OFFSET_TYPECODE, [len(encoded), len(rows), len(blob), len(namespaces)])
+    with open(path, "wb") as ff:
+        ff.write(FILE_MAGIC)
+        ff.write(header.tobytes())
+        ff.write(offsets.tobytes())
+        ff.write(blob + padding(len(blob)))
+        ff.write(namespaces + padding(len(namespaces)))
+        for order in PERMUTATIONS.values():
+            for column in CompactStore.build_index(rows, order):
+                data = column.tobytes()
+                ff.write(data + padding(len(data)))
+
+
+class MappedCompactStore(CompactStore):
+    """
+    CompactStore reading a file written by dump_compact through mmap, without loading its triples or terms in Python objects.
+    """
+
+    def __init__(self, path):
+        Store.__init__(self)
+        self._namespace = {}
+        self._prefix = {}
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        if bytes(view[: len(FILE_MAGIC)]) != FILE_MAGIC:
+            raise Exception("Not a compact graph file for this platform: " + path)
+        cursor = len(FILE_MAGIC)
+        n_terms, n_triples, blob_len, ns_len = view[cursor : cursor + 32].cast(OFFSET_TYPECODE)
+        cursor += 32
+        self.offsets = view[cursor : cursor + 8 * (n_terms + 1)].cast(OFFSET_TYPECODE)
+        cursor += 8 * (n_terms + 1)
+        self.blob = view[cursor : cursor + blob_len]
+        cursor += blob_len + len(padding(blob_len))
+        namespaces = json.loads(bytes(view[cursor : cursor + ns_len]).decode())
+        cursor += ns_len + len(padding(ns_len))
+        self.n_terms = n_terms
+        self.length = n_triples
+        itemsize = array(ID_TYPECODE).itemsize
+        col_len = itemsize * n_triples
+        self.indexes = {}
+        for name in PERMUTATIONS.keys():
+            columns = []
+            for k in range(3):
+                columns.append(view[cursor : cursor + col_len].cast(ID_TYPECODE))
+                cursor += col_len + len(padding(col_len))
+            self.indexes[name] = tuple(columns)
+        self.term = functools.lru_cache(maxsize=TERM_CACHE_SIZE)(self.decode)
+        self.term_id = functools.lru_cache(maxsize=TERM_CACHE_SIZE)(self.search)
+        for prefix, namespace in namespaces:
+            self.bind(prefix, rdflib.URIRef(namespace))
+
+    def raw(self, tid):
+        return bytes(self.blob[self.offsets[tid] : self.offsets[tid + 1]])
+
+    def decode(self, tid):
+        return decode_term(self.raw(tid))
+
+    def search(self, term):
+        """
+        Binary search of the term in the sorted dictionary, return its id or None.
+        """
+        key = encode_term(term)
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_terms and self.raw(lo) == key:
+            return lo
+        return None
+
+
+def load_compact_graph(path):
+    """
+    Return a read-only graph querying a file written by dump_compact.
+    """
+    return rdflib.Graph(store=MappedCompactStore(path))
@@ -1,4 +1,5 @@
 from utils import *
+from graphindex import *
 
 
 def get_datatype(obj):
@@ -6,11 +7,17 @@ def get_datatype(obj):
     return rdflib.XSD.string.toPython() if dt is None else dt.toPython()
 
 
+# Predicates and classes not to explore
+IGNORED_URIS = frozenset(TO_IGNORE + BLACKLIST)
+
+
 def is_valid(pred, obj):
-    if pred.identifier in TO_IGNORE + BLACKLIST:
-        return False
-    val = obj.value(TYPE_PREDICATE_URI) if callable(obj.value) else get_datatype(obj)
-    return val is None or val not in TO_IGNORE + BLACKLIST
+    """
+    Tell if a (predicate, object) pair of the data graph is worth exploring.
+    Only the predicate is checked: the object type used to be compared to TO_IGNORE and BLACKLIST as a rdflib Resource or a python string,
+    neither of which ever equals the URIs of these lists.
+    """
+    return pred not in IGNORED_URIS
 
 
 def extract_value(value, instructions):
@@ -25,14 +32,94 @@ def extract_value(value, instructions):
     return res
 
 
+def compile_transform(instructions):
+    """
+    Return a function applying the instructions the way extract_value does, the attribute getters being built once.
+    """
+    getters = tuple(operator.attrgetter(ins) for ins in instructions)
+
+    def transform(value):
+        for getter in getters:
+            value = getter(value)
+            if callable(value):
+                value = value()
+        return value
+
+    return transform
+
+
+class ValueConverter:
+    """
+    Compiled COLUMNS_MAPPING["VALUE"] entry: the column receiving the values of a datatype, their transform and the constant "misc" cells.
+    """
+
+    __slots__ = ("col", "transform", "misc")
+
+    def __init__(self, item):
+        self.col = item["col"]
+        self.transform = (
+            compile_transform(item["transform"]) if "transform" in item.keys() else None
+        )
+        self.misc = types.MappingProxyType(dict(item.get("misc", {})))
+
+    def apply(self, details, value):
+        details[self.col] = value if self.transform is None else self.transform(value)
+        details.update(self.misc)
+
+
+class ContextField:
+    """
+    Compiled COLUMNS_MAPPING["CONTEXT"] entry: the column of a context type, its flags and the predicates leading to its value.
+    """
+
+    __slots__ = ("col", "mandatory", "overwrite", "chain")
+
+    def __init__(self, item):
+        self.col = item["col"]
+        self.mandatory = item.get("mandatory") == "True"
+        self.overwrite = item.get("overwrite") == "True"
+        self.chain = tuple(rdflib.URIRef(k) for k in item.get("pred_to_value", []))
+
+
+# COLUMNS_MAPPING compiled once, keyed by datatype and context type as python strings
+VALUE_CONVERTERS = {
+    vtype: ValueConverter(item) for vtype, item in COLUMNS_MAPPING["VALUE"].items()
+}
+CONTEXT_FIELDS = {
+    ctype: ContextField(item) for ctype, item in COLUMNS_MAPPING["CONTEXT"].items()
+}
+MANDATORY_COLUMNS = tuple(
+    field.col for field in CONTEXT_FIELDS.values() if field.mandatory
+)
+
+
+# Sub-batches of entry instances along with their first instance number, set before forking so the workers of DataLoader.extract_parallel inherit them
+OBSERVATION_BATCHES = []
+
+
+def convert_subbatch(index):
+    """
+    Return the database lines of a sub-batch of entry instances.
+    """
+    observations, start_instance = OBSERVATION_BATCHES[index]
+    return InformationTree(observations, start_instance=start_instance).get_info_dics()
+
+
 class DataLoader:
     """
-    Manage data conversion from an observation graph. TODO: is there a way to avoid loading the whole graph?
+    Manage data conversion from an observation graph.
     Observations register is performed by batches defined by the type (class) of observations.
+    To avoid loading the whole data graph, a DataLoader can be run on each partition of the data (see main_data.stream_observations),
+    sharing the instance_counters dictionary so instance numbers keep increasing across partitions.
     """
 
     def __init__(
-        self, parser, entrypoints, filename="OBSERVATION_FACT.csv", reset_file=True
+        self,
+        parser,
+        entrypoints,
+        filename="OBSERVATION_FACT.csv",
+        reset_file=True,
+        instance_counters=None,
     ):
         """
         Take a list of class resources.
@@ -41,32 +128,112 @@ class DataLoader:
         self.entry_class_resources = entrypoints
         self.filename = filename
         self.init = reset_file
+        self.instance_counters = {} if instance_counters is None else instance_counters
+        self.current_class = None
+        self.type_index = TypeIndex(
+            self.graph, [res.identifier for res in self.entry_class_resources]
+        )
+        # Built before any InformationTree runs (along with the adjacency view), so forked workers inherit it
+        self.context_resolver = get_index(self.graph, ContextResolver)
+
+    def report_counts(self):
+        """
+        Print the number of instances to convert, known up front from the type index.
+        """
+        counts = self.type_index.counts()
+        print(
+            "Instances to convert: "
+            + str(sum(counts.values()))
+            + " over "
+            + str(len([k for k in counts.values() if k > 0]))
+            + " classes"
+        )
 
     def extract_all(self):
         """
         Trigger sequential writing of batched observation database lines.
         """
+        self.report_counts()
+        if DATA_WORKERS > 1:
+            return self.extract_parallel(DATA_WORKERS)
         nonempty = True
         counter = 0
         while nonempty:
             nonempty = self.write_batch()
             counter = counter + 1 if nonempty else counter
         print("Distinct concepts written: " + str(counter))
+        self.context_resolver.report()
+
+    def extract_parallel(self, workers):
+        """
+        Same as extract_all, the sub-batches of every class being converted by a pool of forked workers.
+        The pool returns the results in order and the lines are written class by class, so the file and the instance numbers are the same as in a serial run.
+        """
+        global OBSERVATION_BATCHES
+        OBSERVATION_BATCHES = []
+        # (class, number of instances, number of sub-batches) in the order extract_all would convert them
+        plan = []
+        planned_counters = dict(self.instance_counters)
+        observations = self.get_next_class_instances()
+        while observations != []:
+            offset = planned_counters.get(self.current_class, 0)
+            sub_batches = self.split_instances(observations, offset)
+            planned_counters[self.current_class] = offset + len(observations)
+            plan.append((self.current_class, len(observations), len(sub_batches)))
+            OBSERVATION_BATCHES.extend(sub_batches)
+            observations = self.get_next_class_instances()
+        counter = 0
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            results = pool.imap(convert_subbatch, range(len(OBSERVATION_BATCHES)))
+            for selclass, nb_obs, nb_subbatches in plan:
+                db = []
+                for _ in range(nb_subbatches):
+                    db.extend(next(results))
+                self.instance_counters[selclass] = (
+                    self.instance_counters.get(selclass, 0) + nb_obs
+                )
+                # A class without any line stops the extraction, as in write_batch
+                if not self.write_db(db):
+                    break
+                counter = counter + 1
+        OBSERVATION_BATCHES = []
+        print("Distinct concepts written: " + str(counter))
 
     def write_batch(self):
         """
         Trigger data conversion and write the db lines in the csv file for the current batch.
         """
-        db = self.convert_data()
+        return self.write_db(self.convert_data())
+
+    def write_db(self, db):
+        """
+        Write the db lines in the csv file, return False if there is none.
+        """
         if db == []:
             return False
-        mode = "w" if self.init else "a"
         db_to_csv(
             db, self.filename, init=self.init, columns=COLUMNS["OBSERVATION_FACT"]
         )
         self.init = False
         return True
 
+    def split_instances(self, observations, offset):
+        """
+        Split the instances of a class into sub-batches of MAX_BATCH_SIZE, returned along with the number of their first instance.
+        offset is the number of instances already numbered for this class.
+        """
+        nb_obs = len(observations)
+        nb_b = int(nb_obs / MAX_BATCH_SIZE)
+        nb_subbatches = nb_b if nb_b * MAX_BATCH_SIZE == nb_obs else nb_b + 1
+        # Give an offset so instance numbers are not reset for every sub batch but for every concept
+        return [
+            (
+                observations[i * MAX_BATCH_SIZE : min(MAX_BATCH_SIZE * (i + 1), nb_obs)],
+                offset + i * MAX_BATCH_SIZE + 1,
+            )
+            for i in range(nb_subbatches)
+        ]
+
     def convert_data(self):
         """
         Get the next batch of entry instances (typically one class at a time using get_next_class_instance), then
@@ -75,21 +242,12 @@ class DataLoader:
         """
         database_batch = []
         observations = self.get_next_class_instances()
-        nb_obs = len(observations)
-        nb_b = int(nb_obs / MAX_BATCH_SIZE)
-        nb_subbatches = nb_b if nb_b * MAX_BATCH_SIZE == nb_obs else nb_b + 1
-        sub_batches = [
-            observations[i * MAX_BATCH_SIZE : min(MAX_BATCH_SIZE * (i + 1), nb_obs)]
-            for i in range(nb_subbatches)
-        ]
-        counter = 0
-        for sub in sub_batches:
-            # Give an offset so instance numbers are not reset for every sub batch but for every concept
-            information_tree = InformationTree(
-                sub, start_instance=counter * MAX_BATCH_SIZE + 1
-            )
+        # Instances already numbered for this concept in previous partitions, if any
+        offset = self.instance_counters.get(self.current_class, 0)
+        for sub, start_instance in self.split_instances(observations, offset):
+            information_tree = InformationTree(sub, start_instance=start_instance)
             database_batch.extend(information_tree.get_info_dics())
-            counter = counter + 1
+        self.instance_counters[self.current_class] = offset + len(observations)
         return database_batch
 
     def get_next_class_instances(self, selclass=None):
@@ -102,20 +260,18 @@ class DataLoader:
         while res == [] and len(self.entry_class_resources) > 0:
             cur = self.entry_class_resources.pop()
             selclass = cur.identifier
-            obs = self.graph.query(
-                """
-                    select ?obs
-                    where {
-                        ?obs rdf:type ?class
-                    }
-                """,
-                initBindings={"class": selclass},
-            )
-            res = [self.graph.resource(k[0]) for k in obs]
+            self.current_class = selclass
+            res = [
+                self.graph.resource(k) for k in self.type_index.instances(selclass)
+            ]
             if res == []:
                 print("No observation for top concept", selclass)
             else:
-                print("Found data for top concept", selclass)
+                print(
+                    "Found data for top concept",
+                    selclass,
+                    "(" + str(len(res)) + " instances)",
+                )
         if res == []:
             print(
                 "No data found. Please check the directories, Makefile volume binding (if using docker) or config files."
@@ -128,9 +284,9 @@ class ObservationRegister:
     Create a proper database line as dict and manages the overwritings of local dict (typically extracted from a FeatureExtractor with other dicts.
     """
 
-    def __init__(self):
+    def __init__(self, adjacency):
+        self.adjacency = adjacency
         self.keys = COLUMNS["OBSERVATION_FACT"]
-        self.value_items = COLUMNS_MAPPING["VALUE"]
         self.records = []
 
     def is_empty(self):
@@ -141,31 +297,27 @@ class ObservationRegister:
 
     def digest(self, resource, parent, basecode, context):
         """
-        Receive a resource which can be embed a rdflib.Literal or a class instance.
+        Receive a rdflib term which can be a rdflib.Literal or a class instance.
         If specified in the config file, class instances should be digged through using the "pred_to_value" list of predicates.
         """
         details = context.copy()
         new_bc = basecode
-        if not callable(resource.value):
+        if isinstance(resource, rdflib.Literal):
             vtype = get_datatype(resource)
-            value = resource.value
-            if not vtype in self.value_items.keys():
+            converter = VALUE_CONVERTERS.get(vtype)
+            if converter is None:
                 raise Exception("Type not defined in config file: ", vtype)
-            if "transform" in self.value_items[vtype].keys():
-                value = extract_value(value, self.value_items[vtype]["transform"])
-            details.update({self.value_items[vtype]["col"]: value})
-            details.update(self.value_items[vtype]["misc"])
+            converter.apply(details, resource.value)
         elif basecode != "@":
-            hdler = I2B2BasecodeHandler()
-            obj_rdftype = resource.value(TYPE_PREDICATE_URI)
+            obj_rdftype = self.adjacency.rdftype(resource)
             # TODO: modify here to support non-untyped NamedIndividuals.
             # Before that, check catching of multiple types works correctly
             if obj_rdftype is not None:
-                el = obj_rdftype.identifier
+                el = obj_rdftype
             else:
                 # Is a NamedIndividual
-                el = resource.identifier
-            new_bc = hdler.reduce_basecode(el, prefix=basecode, debug=DEBUG)
+                el = resource
+            new_bc = BASECODES.code(el, basecode)
         # In any case this digest thing should only add a value field if there is a value, then proceeds with adding the basecode entry in any case
         self.add_record(new_bc, context=details)
 
@@ -192,7 +344,14 @@ class InformationTree:
 
     def __init__(self, resources_list, start_instance=1):
         self.observations = resources_list
-        self.obs_register = ObservationRegister()
+        # The graph is walked through its adjacency view, all the resources of a batch come from the same graph
+        self.resolver = (
+            get_index(resources_list[0].graph, ContextResolver)
+            if resources_list != []
+            else None
+        )
+        self.adjacency = self.resolver.adjacency if self.resolver is not None else None
+        self.obs_register = ObservationRegister(self.adjacency)
         self.offset = start_instance
 
     def get_info_dics(self):
@@ -202,7 +361,7 @@ class InformationTree:
 
     def explore_tree_master(self):
         for i in range(len(self.observations)):
-            obs = self.observations[i]
+            obs = self.observations[i].identifier
             self.explore_obstree(obs, instance_num=i + self.offset, concept=True)
 
     def is_pathend(self, obj):
@@ -215,19 +374,19 @@ class InformationTree:
                 - no type or a SPHN type NamedIndividual without any other predicate
         Else, the obj can be expanded into more predicates and then the search continues.
         """
-        # Workaround to check if an item is a rdflib.resource.Resource or a rdflib.term.Literal
-        if callable(obj.value):
+        if not isinstance(obj, rdflib.Literal):
             # Criteria for having no forward link i.e probably is a valuesetindividual.
             # If the item has no predicate at all, the following test will be evaluated to True
             if all(
                 [
-                    k.identifier in (TYPE_PREDICATE_URI, LABEL_PREDICATE_URI)
-                    for k in obj.predicates()
+                    pred in (TYPE_PREDICATE_URI, LABEL_PREDICATE_URI)
+                    for pred, _ in self.adjacency.pairs(obj)
                 ]
             ):
                 return True
             # We encounter an expandable object BUT it can still be a path end (if the item is a ValusetIndividual or an instance of a Terminology class)
-            if terminology_indicator(obj.value(TYPE_PREDICATE_URI)):
+            rdftype = self.adjacency.rdftype(obj)
+            if rdftype is not None and terminology_keys(rdftype) != ():
                 return True
         else:
             return True
@@ -242,21 +401,28 @@ class InformationTree:
         concept=False,
     ):
         """
-        Recursive function, stop when the current resource has no predicates (leaf).
-        Return the last resource along with the logical path that lead to it as/with the basecode, and information to be used above and in siblings (unit, date, etc.)
+        Walk the observation tree from resource (a rdflib term), stopping when the current resource has no predicates (leaf).
+        The last resources are registered along with the logical path that lead to them as/with the basecode, and information to be used above and in siblings (unit, date, etc.)
+        """
+        root = (resource, basecode_prefix, parent_context, concept, instance_num)
+        visit([root], self.expand_obsnode)
+        return self.obs_register
+
+    def expand_obsnode(self, node):
         """
-        rdfclass = resource.value(TYPE_PREDICATE_URI)
-        if rdfclass.identifier in BLACKLIST + TO_IGNORE or rdfclass is None:
+        Process a node of the observation tree and yield the nodes to explore below it.
+        A node is a (resource, basecode_prefix, parent_context, concept, instance_num) tuple.
+        """
+        resource, basecode_prefix, parent_context, concept, instance_num = node
+        rdfclass = self.adjacency.rdftype(resource)
+        if rdfclass is None or rdfclass in IGNORED_URIS:
             return
         # Updating the basecode that led us to there
-        hdler = I2B2BasecodeHandler()
-        current_basecode = hdler.reduce_basecode(
-            rdfclass.identifier, prefix=basecode_prefix, debug=DEBUG
-        )
+        current_basecode = BASECODES.code(rdfclass, basecode_prefix)
         # Get the properties
-        pred_objects = [k for k in resource.predicate_objects() if is_valid(*k)]
+        pred_objects = [k for k in self.adjacency.pairs(resource) if is_valid(*k)]
         # Digest the context and get back the "clean" list of details
-        context_register = ContextFactory(parent_context)
+        context_register = ContextFactory(self.resolver, parent_context)
         observation_elements = context_register.digest(pred_objects)
         if concept:
             context_register.add_concept_code(
@@ -275,22 +441,62 @@ class InformationTree:
                 context=context_register.get_context(),
             )
 
-        for pred, obj in observation_elements:
-            # Updating the basecode with the forward link
-            basecode = hdler.reduce_basecode(
-                pred.identifier, prefix=current_basecode, debug=DEBUG
-            )
+        # Updating the basecodes with the forward links
+        basecodes = BASECODES.codes(
+            [pred for pred, obj in observation_elements], current_basecode
+        )
+        for (pred, obj), basecode in zip(observation_elements, basecodes):
             if self.is_pathend(obj):
                 self.obs_register.digest(
                     obj, pred, basecode, context_register.get_context()
                 )
             else:
-                self.explore_obstree(
-                    obj,
-                    basecode_prefix=basecode,
-                    parent_context=context_register.get_context(),
-                )
-        return self.obs_register
+                yield (obj, basecode, context_register.get_context(), False, "")
+
+
+class ContextResolver:
+    """
+    Resolve the column value of context elements (units, providers, patients, encounters...) by following their "pred_to_value" chain.
+    Many observations point to the same context nodes, so the values are memoized for as long as the graph is converted.
+    Build it with utils.get_index so there is one per graph.
+    """
+
+    def __init__(self, graph):
+        self.adjacency = get_index(graph, AdjacencyIndex)
+        self.value = functools.lru_cache(maxsize=CONTEXT_CACHE_SIZE)(self.resolve)
+
+    def resolve(self, obj_type, obj):
+        """
+        Return the value of a context element based on the instructions in the config file.
+        """
+        chain = CONTEXT_FIELDS[obj_type].chain
+        if not isinstance(obj, rdflib.Literal):
+            val = self.adjacency.value(obj, chain[0])
+            chain = chain[1:]
+        else:
+            val = obj.value
+        for last_pred in chain:
+            tval = self.adjacency.value(val, last_pred)
+            if tval is None:
+                if self.adjacency.pairs(val) == []:
+                    print("Dead end at ", val)
+                tval = rdflib.URIRef("")
+            val = tval
+        # Unpack both date values that are embedded in a XSD:datetime and the ones that are plain strings (unpacked as datetime.datetime)
+        if isinstance(val, datetime.datetime):
+            return "{:%Y-%m-%d %H:%M:%S}".format(val)
+        elif val is not None:
+            return val.toPython()
+        return ""
+
+    def report(self):
+        info = self.value.cache_info()
+        print(
+            "Context values resolved: "
+            + str(info.misses)
+            + ", reused: "
+            + str(info.hits)
+        )
 
 
 class ContextFactory:
@@ -298,23 +504,27 @@ class ContextFactory:
     Handles contextual information from an observation instance depending on the configured mappings.
     """
 
-    def __init__(self, parent_context={}):
-        self.context = parent_context.copy()
-        self.fields_dic = COLUMNS_MAPPING["CONTEXT"]
+    def __init__(self, resolver, parent_context={}):
+        self.resolver = resolver
+        self.adjacency = resolver.adjacency
+        # The parent context is shared until this factory has something to add to it
+        self.context = parent_context
+        self.owned = False
+
+    def update(self, values):
+        if not self.owned:
+            self.context = self.context.copy()
+            self.owned = True
+        self.context.update(values)
 
     def valid(self):
         """
         Check all mandatory fields for a context are filled in. To be called when ready for writing.
         """
-        for kel in self.fields_dic.keys():
-            el = self.fields_dic[kel]
-            if "mandatory" in el.keys() and el["mandatory"] == "True":
-                if not (
-                    el["col"] in self.context.keys()
-                    and self.context[el["col"]] is not None
-                    and self.context[el["col"]] != ""
-                ):
-                    return False
+        for col in MANDATORY_COLUMNS:
+            value = self.context.get(col)
+            if value is None or value == "":
+                return False
         return True
 
     def digest(self, pred_objects):
@@ -326,10 +536,10 @@ class ContextFactory:
         # If the context holder is empty, extract and save (else simply discard discard the context elements)
         for pred, obj in pred_objects:
             # Get the object type as python string. Can be None (e.g for NamedIndividuals)
-            if callable(obj.value):
-                obj_rdftype = obj.value(TYPE_PREDICATE_URI)
+            if not isinstance(obj, rdflib.Literal):
+                obj_rdftype = self.adjacency.rdftype(obj)
                 obj_type = (
-                    obj_rdftype.identifier.toPython()
+                    obj_rdftype.toPython()
                     if obj_rdftype is not None
                     else None
                 )
@@ -337,12 +547,10 @@ class ContextFactory:
                 obj_rdftype = None
                 obj_type = get_datatype(obj)
 
-            if obj_type is not None and obj_type in self.fields_dic.keys():
+            field = CONTEXT_FIELDS.get(obj_type)
+            if field is not None:
                 # We found a context element, but should we use it?
-                if (
-                    self.fields_dic[obj_type]["overwrite"] == "True"
-                    or obj_type not in self.context.keys()
-                ):
+                if field.overwrite or obj_type not in self.context.keys():
                     # Use it because it's either new or meaningful. Else (implicit) discard
                     self.add_context_element(obj_type, obj)
             else:
@@ -355,38 +563,13 @@ class ContextFactory:
         """
         Add the concept code as a context element (will stand for all modifiers and the concept)
         """
-        self.context.update({"INSTANCE_NUM": instance_num, "CONCEPT_CD": basecode})
+        self.update({"INSTANCE_NUM": instance_num, "CONCEPT_CD": basecode})
 
     def add_context_element(self, obj_type, obj):
         """
         Add a context element based on the instructions in the config file.
         """
-        tmp = (
-            self.fields_dic[obj_type]["pred_to_value"].copy()
-            if "pred_to_value" in self.fields_dic[obj_type].keys()
-            else []
-        )
-        if callable(obj.value):
-            in_pred = rdflib.URIRef(tmp.pop(0))
-            val = obj.value(in_pred)
-        else:
-            val = obj.value
-        while tmp != []:
-            last_pred = rdflib.URIRef(tmp.pop(0))
-            tval = val.value(last_pred)
-            if tval is None:
-                if [k for k in val.predicates()] == []:
-                    print("Dead end at ", val)
-                tval = rdflib.URIRef("")
-            val = tval
-        # Unpack both date values that are embedded in a XSD:datetime and the ones that are plain strings (unpacked as datetime.datetime)
-        if isinstance(val, datetime.datetime):
-            pyval = "{:%Y-%m-%d %H:%M:%S}".format(val)
-        elif val is not None:
-            pyval = val.toPython()
-        else:
-            pyval = ""
-        self.context.update({self.fields_dic[obj_type]["col"]: pyval})
+        self.update({CONTEXT_FIELDS[obj_type].col: self.resolver.value(obj_type, obj)})
 
     def get_context(self):
         return self.context
@@ -0,0 +1,238 @@
+from utils import *
+from compactstore import MappedCompactStore
+
+"""
+This file figures indexes computed once per graph, replacing queries the ontology explorer or the data loader would otherwise run for every concept, property or class.
+Each ontology index is built on first use through utils.get_index.
+"""
+
+
+def is_mapped(graph):
+    """
+    Tell if the graph reads a compact file through mmap (see compactstore.load_compact_graph).
+    Such a graph answers lookups from its sorted permutations, copying all its triples in a Python index would defeat the shared page cache.
+    """
+    return isinstance(graph.store, MappedCompactStore)
+
+
+def list_members(graph, head):
+    """
+    Return the items of a RDF list, the way the SPARQL path rdf:rest*/rdf:first collects them.
+    """
+    members = []
+    seen = set()
+    todo = [head]
+    while todo != []:
+        node = todo.pop(0)
+        if node in seen:
+            continue
+        seen.add(node)
+        members.extend(graph.objects(node, rdflib.RDF.first))
+        todo.extend(graph.objects(node, rdflib.RDF.rest))
+    return members
+
+
+def union_members(graph, node):
+    """
+    Return the classes listed in node if it is an owl:Class defined as an owl:unionOf, else an empty list.
+    """
+    if (node, rdflib.RDF.type, rdflib.OWL.Class) not in graph:
+        return []
+    members = []
+    for head in graph.objects(node, rdflib.OWL.unionOf):
+        members.extend(list_members(graph, head))
+    return members
+
+
+class DomainIndex:
+    """
+    Map every class to its most specific properties, i.e the properties having the class as rdfs:domain, either directly or as member of an owl:unionOf domain,
+    for which no subproperty (through rdfs:subPropertyOf+) also has the class as domain.
+    This is the result of the per-concept query PropertyFilter.fetch_unique_properties used to run, including its duplicates and order (direct domains first).
+    """
+
+    def __init__(self, graph):
+        direct = {}
+        union = {}
+        for prop, dom in graph.subject_objects(rdflib.RDFS.domain):
+            direct.setdefault(dom, []).append(prop)
+            for member in union_members(graph, dom):
+                union.setdefault(member, []).append(prop)
+        self.superproperties = {}
+        for child, parent in graph.subject_objects(rdflib.RDFS.subPropertyOf):
+            self.superproperties.setdefault(child, []).append(parent)
+        self.ancestors_cache = {}
+        self.index = {}
+        for cls in set(direct.keys()) | set(union.keys()):
+            props = direct.get(cls, []) + union.get(cls, [])
+            shadowed = set()
+            for child in set(props):
+                shadowed.update(self.ancestors(child))
+            self.index[cls] = [prop for prop in props if prop not in shadowed]
+
+    def ancestors(self, prop):
+        """
+        Return the set of properties reachable from prop through one or more rdfs:subPropertyOf links.
+        """
+        if prop in self.ancestors_cache:
+            return self.ancestors_cache[prop]
+        res = set()
+        todo = list(self.superproperties.get(prop, []))
+        while todo != []:
+            cur = todo.pop()
+            if cur in res:
+                continue
+            res.add(cur)
+            todo.extend(self.superproperties.get(cur, []))
+        self.ancestors_cache[prop] = res
+        return res
+
+    def properties(self, cls):
+        return self.index.get(cls, [])
+
+
+class RangeIndex:
+    """
+    Map every property to the classes it ranges over (through RANGE_PREDICATE_URI), a range defined as an owl:unionOf being replaced by its members.
+    """
+
+    def __init__(self, graph):
+        self.index = {}
+        for prop, rnge in graph.subject_objects(RANGE_PREDICATE_URI):
+            ranges = self.index.setdefault(prop, [])
+            members = union_members(graph, rnge)
+            for cls in members if members != [] else [rnge]:
+                if cls not in ranges:
+                    ranges.append(cls)
+
+    def ranges(self, prop):
+        return self.index.get(prop, [])
+
+
+class SubclassIndex:
+    """
+    Map every class to its direct subclasses (through SUBCLASS_PRED), in the order the graph yields them.
+    On a mapped graph nothing is collected, the subclasses of a class are looked up in the store when asked for.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.direct = is_mapped(graph)
+        if self.direct:
+            return
+        self.index = {}
+        for child, parent in graph.subject_objects(SUBCLASS_PRED):
+            self.index.setdefault(parent, []).append(child)
+
+    def children(self, cls):
+        if self.direct:
+            return list(self.graph.subjects(SUBCLASS_PRED, cls))
+        return self.index.get(cls, [])
+
+
+class LabelIndex:
+    """
+    Labels and comment of every subject of the graph, read in one pass over the rdfs:label and comment triples.
+    Labels are kept in the order the subject lists them, the preferred one is picked by language.
+    On a mapped graph nothing is collected, the labels and comment of a subject are looked up when asked for.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.direct = is_mapped(graph)
+        if self.direct:
+            return
+        self.labels = self.collect(graph, rdflib.RDFS.label)
+        self.comments = {
+            subject: values[0]
+            for subject, values in self.collect(graph, COMMENT_PREDICATE_URI).items()
+        }
+
+    @staticmethod
+    def collect(graph, predicate):
+        res = {}
+        for subject, value in graph.subject_objects(predicate):
+            res.setdefault(subject, []).append(value)
+        for subject, values in res.items():
+            if len(values) > 1:
+                # The predicate-wide pass does not follow the order of each subject, read it again
+                res[subject] = list(graph.objects(subject, predicate))
+        return res
+
+    def preferred_label(self, subject, language):
+        """
+        Return the label in the given language, falling back on the first label, or "" if there is none.
+        """
+        if self.direct:
+            labels = list(self.graph.objects(subject, rdflib.RDFS.label))
+        else:
+            labels = self.labels.get(subject, [])
+        if len(labels) == 1:
+            return labels[0].toPython()
+        if len(labels) == 0:
+            return ""
+        for label in labels:
+            if label.language == language:
+                return label.toPython()
+        return labels[0].toPython()
+
+    def comment(self, subject):
+        if self.direct:
+            com = next(self.graph.objects(subject, COMMENT_PREDICATE_URI), None)
+        else:
+            com = self.comments.get(subject)
+        return com.toPython() if com is not None else com
+
+
+class TypeIndex:
+    """
+    Map each of the given classes to its instances (through rdf:type), read in one pass over the rdf:type triples.
+    Instances of a class come in the order the graph yields them for that class, which is the order of the per-class query DataLoader used to run.
+    """
+
+    def __init__(self, graph, classes):
+        self.index = {cls: [] for cls in classes}
+        for subject, cls in graph.subject_objects(rdflib.RDF.type):
+            instances = self.index.get(cls)
+            if instances is not None:
+                instances.append(subject)
+
+    def instances(self, cls):
+        return self.index.get(cls, [])
+
+    def counts(self):
+        return {cls: len(instances) for cls, instances in self.index.items()}
+
+
+class AdjacencyIndex:
+    """
+    Flattened view of a data graph: every subject mapped to its (predicate, object) pairs and to its type, read once per subject.
+    Pairs come in the order Resource.predicate_objects yields them, and the type is the TYPE_PREDICATE_URI object Resource.value would return.
+    """
+
+    def __init__(self, graph):
+        self.index = {}
+        self.types = {}
+        # A single pass over all the triples would not give the per-subject order, which the observation lines follow
+        for subject in graph.subjects(unique=True):
+            pairs = list(graph.predicate_objects(subject))
+            self.index[subject] = pairs
+            for pred, obj in pairs:
+                if pred == TYPE_PREDICATE_URI:
+                    self.types[subject] = obj
+                    break
+
+    def pairs(self, subject):
+        return self.index.get(subject, [])
+
+    def rdftype(self, subject):
+        return self.types.get(subject)
+
+    def value(self, subject, predicate):
+        """
+        Return the first object of the subject for this predicate, or None.
+        """
+        for pred, obj in self.index.get(subject, []):
+            if pred == predicate:
+                return obj
+        return None
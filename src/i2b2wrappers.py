@@ -1,24 +1,56 @@
 from rdfwrappers import *
 
 
+DROP_URIS = frozenset(ONTOLOGY_DROP_DIC)
+# (dropped uri, parent uri) couples to be kept anyway
+UNDROP_PAIRS = frozenset(
+    [(droppy, parent) for droppy, parents in UNDROP_LEAVES.items() for parent in parents]
+)
+
+
+class DropDecisions(GraphMemo):
+    """
+    Drop decisions taken on a graph, keyed by the attribute (uri, class, terminology flag).
+    """
+
+
 def drop(attribute):
     """
     If the attribute should be dropped because it points to a class referenced in the config file, skip it
+    The children of an attribute only depend on its uri, class and terminology flag, so the decision is taken once per graph.
     """
-    for rn in attribute.get_children(verbose=False):
-        cur_uri = rn.get_uri()
-        if cur_uri in ONTOLOGY_DROP_DIC:
-            return cur_uri
-    return False
+    decisions = get_index(attribute.resource.graph, DropDecisions)
+    key = (
+        attribute.resource.identifier,
+        type(attribute),
+        attribute.is_terminology_term,
+    )
+    if key not in decisions:
+        decisions[key] = False
+        for rn in attribute.get_children(verbose=False):
+            cur_uri = rn.get_uri()
+            if cur_uri in DROP_URIS:
+                decisions[key] = cur_uri
+                break
+    return decisions[key]
 
 
 def save_from_drop(droppy_uri, parent_uri):
     """
     Handles corner cases for attributes that are normally dropped but are exceptionally kept.
     """
-    if droppy_uri in UNDROP_LEAVES.keys() and parent_uri in UNDROP_LEAVES[droppy_uri]:
-        return True
-    return False
+    return (droppy_uri, parent_uri) in UNDROP_PAIRS
+
+
+# Concepts converted by the forked workers of I2B2Converter.get_parallel_batches, inherited from the parent process
+CONCEPTS_TOCONVERT = []
+
+
+def convert_concept(index):
+    """
+    Return the db lines of a concept along with its modifiers ones.
+    """
+    return list(CONCEPTS_TOCONVERT[index].iter_db_lines())
 
 
 class I2B2Converter:
@@ -26,42 +58,65 @@ class I2B2Converter:
     The converter object initialized with a python rdfwrappers.Concept instance.
     All concepts related to this instance (i.e it and its subconcepts) are converted to an i2b2 concept object (taking the hierarchy into account)
     From this object can be triggered the modifiers generation.
+    The conversion is lazy: the db lines are produced while the tree is walked, so only the current branch is kept in memory.
     """
 
     def __init__(self, concept, i2b2parent=None):
+        self.concept = concept
+        self.i2b2parent = i2b2parent
+        self.lines = None
+        self.towrite = []
+
+    def iter_i2b2concepts(self):
         """
-        Extract and instantiate all the i2b2concepts for this run.
+        Yield the i2b2concepts of this run, parents before children.
         They are found by navigating through the subconcepts tree (ignoring the properties) defined in rdfwrappers.
         """
-        self.i2b2voidconcepts = []
-        self.left_tosearch = []
-        # Exploring into our concept
+
+        def expand(cur):
+            # Expanding the modifiers of a real concept digs its subconcepts further, so the directory structure is fixed before yielding
+            subconcepts = list(cur.component.subconcepts)
+            return (self.cast_concept(sub, cur) for sub in subconcepts)
+
+        return traverse([self.cast_concept(self.concept, self.i2b2parent)], expand)
+
+    def cast_concept(self, concept, i2b2parent):
         cur = I2B2Concept(concept, i2b2parent)
         concept.get_entry_desc()
-        # If it's not a directory, register it to be modifier-expanded. Stop condition of the recursion.
-        if concept.subconcepts == []:
-            self.left_tosearch.append(cur)
-            return
-        # Else, register it to be written out - but not expanded, and renew the operation on its subconcepts
-        cur.visual = "CA"
-        self.i2b2voidconcepts.append(cur)
-        for sub in concept.subconcepts:
-            next = I2B2Converter(sub, cur)
-            self.left_tosearch.extend(next.left_tosearch)
-            self.i2b2voidconcepts.extend(next.i2b2voidconcepts)
+        # If it's a directory, it is written out but not expanded, and the operation is renewed on its subconcepts
+        if concept.subconcepts != []:
+            cur.visual = "CA"
+        return cur
+
+    def iter_lines(self):
+        """
+        Yield the db lines of the directory concepts, and of the real concepts followed by their modifier tree.
+        """
+        for cur in self.iter_i2b2concepts():
+            yield from cur.iter_db_lines()
 
     def get_batch(self):
-        # First flush the directory concepts (that do not span modifiers) if any
-        self.towrite = [k.get_db_line() for k in self.i2b2voidconcepts]
-        self.i2b2voidconcepts = []
-        # Then taking the next real concept (spanning a modifier tree)
-        if self.left_tosearch == []:
-            return False
-        cur = self.left_tosearch.pop()
-        print("Exploring concept ", cur)
-        cur.extract_modelems()
-        self.towrite.extend([k.get_db_line() for k in [cur] + cur.modifiers])
-        return True
+        """
+        Fill self.towrite with the next WRITE_BATCH_SIZE lines at most. Return False once all lines were produced.
+        """
+        if self.lines is None:
+            self.lines = self.iter_lines()
+        self.towrite = list(itertools.islice(self.lines, int(WRITE_BATCH_SIZE)))
+        return self.towrite != []
+
+    def get_parallel_batches(self, workers):
+        """
+        Same lines as successive get_batch calls, the concepts being converted by a pool of forked workers.
+        Yield True each time self.towrite holds the lines of a new concept. The pool returns the results in order, so the lines are the same as in a serial run.
+        """
+        global CONCEPTS_TOCONVERT
+        # The concepts (not their modifiers) are placed before forking so the workers inherit them
+        CONCEPTS_TOCONVERT = list(self.iter_i2b2concepts())
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            for lines in pool.imap(convert_concept, range(len(CONCEPTS_TOCONVERT))):
+                self.towrite = lines
+                yield True
+        CONCEPTS_TOCONVERT = []
 
     def write(self, filepath=OUTPUT_TABLES_LOCATION + "METADATA.csv", init_table=False):
         """
@@ -72,6 +127,21 @@ class I2B2Converter:
 
 
 class I2B2OntologyElement:
+    __slots__ = (
+        "parent",
+        "logical_parent",
+        "component",
+        "root",
+        "path",
+        "code",
+        "displayname",
+        "level",
+        "comment",
+        "line_updates",
+        "visual",
+        "applied_path",
+    )
+
     def __init__(self, graph_component, parent=None, explicit_logical_parent=None):
         self.parent = parent
         if explicit_logical_parent is not None:
@@ -87,8 +157,6 @@ class I2B2OntologyElement:
                 else parent.logical_parent
             )
         self.component = graph_component
-        self.basecode_handler = I2B2BasecodeHandler(self)
-        self.path_handler = I2B2PathResolver(self)
         self.set_root()
         self.set_path()
         self.set_code()
@@ -98,6 +166,17 @@ class I2B2OntologyElement:
         self.line_updates = {}
         self.visual = None
 
+    @property
+    def basecode_handler(self):
+        """
+        Handlers are created on demand, the element only keeps the resulting path and code.
+        """
+        return I2B2BasecodeHandler(self)
+
+    @property
+    def path_handler(self):
+        return I2B2PathResolver(self)
+
     def set_root(self):
         if self.parent is not None:
             if self.parent.root == "\\":
@@ -114,7 +193,8 @@ class I2B2OntologyElement:
         self.displayname = self.component.get_label()
 
     def set_code(self):
-        self.code = self.basecode_handler.get_basecode()
+        prefix = self.logical_parent.code if self.logical_parent is not None else ""
+        self.code = BASECODES.code(self.component.get_uri(), prefix)
 
     def set_level(self):
         if self.parent is None:
@@ -128,27 +208,41 @@ class I2B2OntologyElement:
     def mutate_valueinfo(self, datatype_string):
         """
         Some observations can store a value. In that case, the corresponding ontology element should specify the value type both in the valuetype_cd and in the XML form.
+        The returned cells are shared by all elements, read-only.
         """
-        ont_values_cells = EQUIVALENCES[datatype_string].copy()
-        metadata = generate_xml(ont_values_cells["C_METADATAXML"])
-        ont_values_cells.update({"C_METADATAXML": metadata})
-        return ont_values_cells
+        return COMPILED_EQUIVALENCES[datatype_string]
 
     def walk_mtree(self, counter=0):
-        res = []
-        submods = self.get_filtered_children()
+        return list(self.iter_mtree(counter=counter))
+
+    def iter_mtree(self, submods=None, counter=0):
+        """
+        Yield the modifiers below self, each one before its own modifiers.
+        The children of a modifier are filtered (absorb_child_info) before it is yielded, so its line is already complete.
+        """
+        if submods is None:
+            submods = self.absorb_children()
+
+        def expand(modifier):
+            return modifier.cast_modifiers(modifier.absorb_children())
+
+        return traverse(self.cast_modifiers(submods, verbose=counter == 0), expand)
+
+    def cast_modifiers(self, submods, verbose=False):
         for component in submods:
-            if not self.absorb_child_info(component):
-                cur = I2B2Modifier(
-                    component, parent=self, applied_path=self.applied_path
-                )
-                new_counter = counter + 1
-                if new_counter < 2:
-                    print("Casting i2b2 object from ", component)
-                next = cur.walk_mtree(counter=new_counter)
-                res.append(cur)
-                res.extend(next)
-        return res
+            if verbose:
+                print("Casting i2b2 object from ", component)
+            yield I2B2Modifier(component, parent=self, applied_path=self.applied_path)
+
+    def absorb_children(self):
+        """
+        Return the children to be cast as modifiers, the other ones being merged in the current element.
+        """
+        return [
+            component
+            for component in self.get_filtered_children()
+            if not self.absorb_child_info(component)
+        ]
 
     def absorb_child_info(self, child_component):
         # Check if the child's URI is a primary data type. If so, its information does not justify creating a new ontology item but is written in the xml field.
@@ -217,10 +311,26 @@ class I2B2OntologyElement:
 
 
 class I2B2Concept(I2B2OntologyElement):
+    __slots__ = ("modifiers",)
+
     def extract_modelems(self):
         self.applied_path = self.path
         self.modifiers = self.walk_mtree()
 
+    def iter_db_lines(self):
+        """
+        Yield the db line of the concept, then the ones of its modifiers unless it is a directory.
+        """
+        if self.visual == "CA":
+            yield self.get_db_line()
+            return
+        print("Exploring concept ", self)
+        self.applied_path = self.path
+        submods = self.absorb_children()
+        yield self.get_db_line()
+        for modifier in self.iter_mtree(submods):
+            yield modifier.get_db_line()
+
     def get_root(self):
         return self.root
 
@@ -252,6 +362,8 @@ class I2B2Concept(I2B2OntologyElement):
 
 
 class I2B2PathResolver:
+    __slots__ = ("element", "path")
+
     def __init__(self, i2b2ontelem):
         self.element = i2b2ontelem
         self.path = ""
@@ -261,12 +373,14 @@ class I2B2PathResolver:
             if self.element.parent is None:
                 parent_path = self.element.get_root()
             else:
-                parent_path = self.element.parent.path_handler.get_path()
+                parent_path = self.element.parent.path
             self.path = parent_path + self.element.component.get_shortname() + "\\"
         return self.path
 
 
 class I2B2Modifier(I2B2OntologyElement):
+    __slots__ = ("applied_concept",)
+
     def __init__(self, component2, parent, applied_path):
         # Handle the case where a concept created self and registered as parent: discard (keep only modifier hierarchy)
         if parent.path == applied_path:
@@ -5,8 +5,18 @@ from starschema import init_star_schema, query_providers
 import subprocess
 import shutil
 
+def data_filter():
+    """
+    Return the TripleFilter to apply while parsing the data graphs if FILTER_AT_PARSING is set, else None.
+    """
+    return TripleFilter() if FILTER_AT_PARSING == "True" else None
+
+
 def load_observations():
-    parser = GraphParser(paths=[DATA_GRAPHS_LOCATION, CONTEXT_GRAPHS_LOCATION])
+    parser = GraphParser(
+        paths=[DATA_GRAPHS_LOCATION, CONTEXT_GRAPHS_LOCATION],
+        triple_filter=data_filter(),
+    )
     parser.define_namespaces()
     entry_classes = parser.get_entrypoints(ENTRY_DATA_CONCEPTS)
     dl = DataLoader(
@@ -19,12 +29,49 @@ def load_observations():
     return parser
 
 
+def stream_observations():
+    """
+    Streaming variant of load_observations, used if DATA_STREAMING is set to "True".
+    Each file of DATA_GRAPHS_LOCATION is a partition: it is loaded along with the context graphs, converted, then freed.
+    The context graphs (e.g units) are parsed once and stay in memory. Each partition must be self-contained,
+    i.e an observation and the patient, encounter and provider nodes it points to have to be in the same file.
+    Return the providers found in the partitions, as query_providers would on the whole graph.
+    """
+    triple_filter = data_filter()
+    context = GraphParser(paths=[CONTEXT_GRAPHS_LOCATION], triple_filter=triple_filter)
+    instance_counters = {}
+    providers = []
+    init = True
+    for filek in list_graph_files([DATA_GRAPHS_LOCATION]):
+        # The context is merged in the partition afterwards, so the partition graph must stay writable
+        parser = GraphParser(paths=[filek], triple_filter=triple_filter, compact=False)
+        if len(parser.graph) == 0:
+            continue
+        parser.graph += context.graph
+        entry_classes = parser.get_entrypoints(ENTRY_DATA_CONCEPTS)
+        dl = DataLoader(
+            parser,
+            entry_classes,
+            filename=OUTPUT_TABLES_LOCATION + "OBSERVATION_FACT.csv",
+            reset_file=init,
+            instance_counters=instance_counters,
+        )
+        dl.extract_all()
+        init = dl.init
+        providers.extend([k for k in query_providers(parser) if k not in providers])
+        parser.free_memory()
+    return providers
+
+
 if __name__ == "__main__":
 
     create_dir(OUTPUT_TABLES_LOCATION)
-    graphparser = load_observations()
-    providers_generator = query_providers(graphparser)
-    graphparser.free_memory()
+    if DATA_STREAMING == "True":
+        providers_generator = stream_observations()
+    else:
+        graphparser = load_observations()
+        providers_generator = query_providers(graphparser)
+        graphparser.free_memory()
     # Run scripts to modify the table according to project-specific purposes
     transfer_obs_numerical_values(OUTPUT_TABLES_LOCATION)
     # i2b2 star schema tables creation
@@ -29,6 +29,12 @@ def generate_ontology_table():
         # Initialize the converter using the list of objects
         converter = I2B2Converter(concept)
         # Get the i2b2 db lines related to this concept
+        workers = int(ONTOLOGY_WORKERS)
+        if workers > 1:
+            for buffer in converter.get_parallel_batches(workers):
+                converter.write(OUTPUT_TABLES_LOCATION + "METADATA.csv", init_table=init)
+                init = False
+            continue
         buffer = converter.get_batch()
         while buffer:
             converter.write(OUTPUT_TABLES_LOCATION + "METADATA.csv", init_table=init)
@@ -1,4 +1,5 @@
 from utils import *
+from graphindex import *
 
 # add patient, encounter,  provider info in the blacklist to speedup the searches. usually should not be discarded at this stage since i2b2 takes care of them
 
@@ -12,8 +13,18 @@ def filter_valid(res_list):
 class Component:
     """
     Component is a wrapper for the rdflib.Resource class.
+    Components exist by hundreds of thousands when expanding terminologies, so they use slots and do not keep helper objects.
     """
 
+    __slots__ = (
+        "is_terminology_term",
+        "resource",
+        "shortname",
+        "parent_class",
+        "comment",
+        "label",
+    )
+
     def __init__(self, resource, parent_class=None):
         self.is_terminology_term = (
             terminology_indicator(resource)
@@ -25,8 +36,9 @@ class Component:
         )
         self.set_shortname()
         self.parent_class = parent_class
-        com = resource.value(COMMENT_PREDICATE_URI)
-        self.comment = com.toPython() if com is not None else com
+        self.comment = get_index(resource.graph, LabelIndex).comment(
+            resource.identifier
+        )
         self.set_label()
 
     def switch_graph(self, resource):
@@ -81,20 +93,9 @@ class Component:
         """
         Homemade method to get the label of the preferred tag. Replaces rdflib.Graph.prefLabel (removed from lib)
         """
-        labels = [
-            k[1]
-            for k in self.resource.predicate_objects()
-            if k[0].identifier == rdflib.RDFS.label
-        ]
-        if len(labels) == 1:
-            return labels[0].toPython()
-        if len(labels) == 0:
-            return ""
-        # More than 1 label, let's filter along language tags
-        res = [k.toPython() for k in labels if k.language == PREF_LANGUAGE]
-        if len(res) == 0:
-            return labels[0].toPython()
-        return res[0]
+        return get_index(self.resource.graph, LabelIndex).preferred_label(
+            self.resource.identifier, PREF_LANGUAGE
+        )
 
     def set_label(self):
         """
@@ -133,11 +134,19 @@ class Component:
 
 
 class Concept(Component):
+    __slots__ = ("subconcepts", "properties")
+
     def __init__(self, resource, parent_class=None):
         super().__init__(resource, parent_class)
         self.subconcepts = []
         self.properties = []
-        self.resolver = OntologyDepthExplorer(self)
+
+    @property
+    def resolver(self):
+        """
+        The explorer is created on demand, most concepts never need to search for properties.
+        """
+        return OntologyDepthExplorer(self)
 
     def get_entry_desc(self):
         """
@@ -160,11 +169,15 @@ class Concept(Component):
 
     def explore_children(self):
         """
-        Recursively populate the subconcepts and properties.
+        Populate the subconcepts and properties of the whole subtree, the subconcepts being completed before their parent.
         """
-        for k in self.find_subconcepts():
-            k.explore_children()
+        visit(
+            [self],
+            lambda concept: concept.find_subconcepts(),
+            leave=lambda concept: concept.dig_properties(),
+        )
 
+    def dig_properties(self):
         if self.is_terminology_term:
             return
 
@@ -176,11 +189,16 @@ class Concept(Component):
 
     def find_subconcepts(self, filter_mode="blacklist"):
         if len(self.subconcepts) == 0:
-            self.subconcepts = self.resolver.explore_subclasses(filter_mode)
-            # Trigger recursive call on first-level children
-            for sub in self.subconcepts:
-                sub.find_subconcepts(filter_mode)
+            visit([self], lambda concept: concept.fetch_subconcepts(filter_mode))
+        return self.subconcepts
 
+    def fetch_subconcepts(self, filter_mode):
+        """
+        Fetch the direct subconcepts if not done yet, and return the ones to be searched further.
+        """
+        if len(self.subconcepts) != 0:
+            return []
+        self.subconcepts = self.resolver.explore_subclasses(filter_mode)
         return self.subconcepts
 
 
@@ -193,6 +211,8 @@ class ChildfreeConcept(Concept):
     To implement this, simply override find_subconcepts.
     """
 
+    __slots__ = ()
+
     def find_subconcepts(self, filter_mode="blacklist"):
         return []
 
@@ -202,11 +222,47 @@ class LeafConcept(ChildfreeConcept):
     LeafConcepts are leaves of the tree, by definition. By the ChildfreeConcept inheritance, they have no subconcepts. On top of that, they have no useful properties.
     """
 
+    __slots__ = ()
+
     def explore_children(self):
         return
 
 
+class ExpandedRanges(GraphMemo):
+    """
+    Range components already expanded on a graph, keyed by (range uri, concept class).
+    Ranges shared by many properties (codes, units, quantities...) are explored once, the i2b2 elements built on top of them compute their paths from their own parents.
+    """
+
+
+def range_graph(resource):
+    """
+    Return the graph the components of a range live in: its terminology graph if it has one, else its own graph.
+    """
+    graph = which_graph(resource.identifier) if terminology_indicator(resource) else False
+    return resource.graph if graph is False else graph
+
+
+def expand_range(resource, concept_class):
+    """
+    Return the components a property range stands for: the explored concept, or the instances of a valueset.
+    """
+    expanded = get_index(range_graph(resource), ExpandedRanges)
+    key = (resource.identifier, concept_class)
+    if key not in expanded:
+        obj = concept_class(resource)
+        if obj.is_valueset():
+            expanded[key] = obj.resolver.explore_valueset()
+        else:
+            expanded[key] = [obj]
+            # The explore method will trigger subclasses and properties discovery
+            obj.explore_children()
+    return expanded[key]
+
+
 class Property(Component):
+    __slots__ = ("ranges_res", "ranges")
+
     def __init__(self, resource, valid_ranges):
         super().__init__(resource)
         self.ranges_res = valid_ranges
@@ -219,16 +275,11 @@ class Property(Component):
         prop_type = self.resource.value(TYPE_PREDICATE_URI)
         if prop_type is None or prop_type.identifier == OBJECT_PROP_URI:
             processed_range_res = self.sort_silent_ranges()
-            raw_ranges = [Concept(reg) for reg in processed_range_res["regular"]] + [
-                ChildfreeConcept(gen) for gen in processed_range_res["muted"]
+            raw_ranges = [(reg, Concept) for reg in processed_range_res["regular"]] + [
+                (gen, ChildfreeConcept) for gen in processed_range_res["muted"]
             ]
-            for obj in raw_ranges:
-                # The explore method will trigger subclasses and properties discovery
-                if obj.is_valueset():
-                    self.ranges.extend(obj.resolver.explore_valueset())
-                else:
-                    obj.explore_children()
-                    self.ranges.append(obj)
+            for range_res, concept_class in raw_ranges:
+                self.ranges.extend(expand_range(range_res, concept_class))
         elif prop_type.identifier == DATATYPE_PROP_URI:
             # The ranges are tree leaf objects without properties and without subclasses
             self.ranges = [LeafConcept(reg) for reg in self.ranges_res]
@@ -281,6 +332,8 @@ class RangeFilter:
     Fetch and filter the Range elements of a Property discarding the blacklisted ones.
     """
 
+    __slots__ = ("resource",)
+
     def __init__(self, res):
         self.resource = res
 
@@ -296,30 +349,11 @@ class RangeFilter:
         Return the range type of the property, expanding the bnode if any.
         The return value is a list.
         """
-        response = self.resource.graph.query(
-            """
-        SELECT DISTINCT ?class 
-        where {
-            {
-            ?self ?range ?class }
-            union
-            {
-                ?self ?range [ a owl:Class ;
-                                    owl:unionOf [ rdf:rest*/rdf:first ?class ]
-                ]
-                    }
-        }
-        """,
-            initBindings={
-                "self": self.resource.identifier,
-                "range": RANGE_PREDICATE_URI,
-            },
-        )
-        listed_res = [self.resource.graph.resource(row[0]) for row in response]
-        # If there are several ranges, remove the first element which is in fact the name of the blank node
-        if len(listed_res) > 1:
-            listed_res = listed_res[1:]
-        return listed_res
+        graph = self.resource.graph
+        return [
+            graph.resource(rnge)
+            for rnge in get_index(graph, RangeIndex).ranges(self.resource.identifier)
+        ]
 
 
 class PropertyFilter:
@@ -333,6 +367,8 @@ class PropertyFilter:
     remove this property.
     """
 
+    __slots__ = ("concept", "resources")
+
     def __init__(self, concept):
         self.concept = concept
         self.resources = []
@@ -373,42 +409,17 @@ class PropertyFilter:
         """
         Extract the (predicate, object TYPE) couples for predicates of a resource.
         Extracts only finest properties uris, which means if two properties are related (hierarchy), only the most specific is kept.
+        The properties are looked up in the DomainIndex of the graph, built once instead of querying the graph for each concept.
         """
         if self.resources != []:
             return
         self_res = self.concept.resource
-        response = self_res.graph.query(
-            """
-            SELECT ?p 
-            WHERE {
-                {
-                ?p rdfs:domain ?self 
-                }
-                UNION
-                {
-                ?p rdfs:domain [ a owl:Class ;
-                                    owl:unionOf [ rdf:rest*/rdf:first ?self ]
-                                ]
-                }
-                FILTER NOT EXISTS { 
-                    ?child rdfs:subPropertyOf+ ?p .
-                    {
-                    ?child rdfs:domain ?self 
-                    }
-                    UNION
-                    {
-                    ?child rdfs:domain [ a owl:Class ;
-                                        owl:unionOf [ rdf:rest*/rdf:first ?self ]
-                                    ]
-                    }
-                }
-            }
-        """,
-            initBindings={"self": self_res.identifier},
-        )
-
+        graph = self_res.graph
         # Extract all resources referencing this class as their domain
-        self.resources = [self_res.graph.resource(row[0]) for row in response]
+        self.resources = [
+            graph.resource(prop)
+            for prop in get_index(graph, DomainIndex).properties(self_res.identifier)
+        ]
 
 
 class OntologyDepthExplorer:
@@ -417,6 +428,8 @@ class OntologyDepthExplorer:
     All searches are done recursively, fetching only the first level of children and creating an other OntologyDepthExplorer object for
     """
 
+    __slots__ = ("concept", "filter")
+
     def __init__(self, concept):
         self.concept = concept
         self.filter = PropertyFilter(concept)
@@ -425,23 +438,21 @@ class OntologyDepthExplorer:
         """
         Fetch the direct subclasses of the concept. Reference the parent_class concept.
         If the current node is a terminology element, all its predicate can be in a separate graph.
+        The subclasses are read from the SubclassIndex of the concept graph.
         """
-        subs = self.concept.resource.subjects(SUBCLASS_PRED)
-        if subs is None:
-            return []
+        resource = self.concept.resource
+        subs = get_index(resource.graph, SubclassIndex).children(resource.identifier)
+        # Filter on the uris before instantiating any Concept
         if filter_mode == "blacklist":
-            return [
-                Concept(sub, parent_class=self.concept)
-                for sub in subs
-                if sub.identifier not in BLACKLIST
-            ]
+            subs = [sub for sub in subs if sub not in BLACKLIST]
         elif filter_mode == "whitelist":
-            return [
-                Concept(sub, parent_class=self.concept)
-                for sub in subs
-                if sub.identifier in ENTRY_CONCEPTS
-            ]
-        return []
+            subs = [sub for sub in subs if sub in ENTRY_CONCEPTS]
+        else:
+            return []
+        return [
+            Concept(resource.graph.resource(sub), parent_class=self.concept)
+            for sub in subs
+        ]
 
     def explore_properties(self):
         """
@@ -0,0 +1,34 @@
+import os
+import sys
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + "/../")
+from utils import *
+from compactstore import dump_compact
+
+
+def compact_terminologies(
+    location=COMPACT_TERMINOLOGIES_LOCATION, paths=ONTOLOGY_GRAPHS_LOCATIONS
+):
+    """
+    Parse the terminology files found in the ontology locations and export each of them as a compact file in the given location.
+    GraphParser then memory-maps these files instead of parsing the terminologies, as long as COMPACT_TERMINOLOGIES_LOCATION points to them.
+    Rerun it whenever a terminology file is updated.
+    """
+    create_dir(location)
+    for filek in list_graph_files(paths):
+        fname = graph_name(filek)
+        rdf_format = rdflib.util.guess_format(filek)
+        if fname not in TERMINOLOGIES_GRAPHS.values() or rdf_format is None:
+            continue
+        print("Compacting", fname)
+        graph = parse_graph_file(filek, rdf_format)
+        dump_compact(graph, compact_terminology_path(fname, location))
+        del graph
+        gc.collect()
+
+
+if __name__ == "__main__":
+    compact_terminologies(
+        sys.argv[1] if len(sys.argv) > 1 else COMPACT_TERMINOLOGIES_LOCATION
+    )
@@ -3,8 +3,17 @@ import pdb
 import hashlib
 import glob
 import rdflib
+from compactstore import compact_graph, load_compact_graph
 import json, os, sys, datetime
 import gc
+import collections
+import multiprocessing
+import pickle
+import functools
+import itertools
+import re
+import types
+import operator
 
 """"
 This file figures file and format utility functions.
@@ -12,6 +21,22 @@ It initializes global variables by reading the "ontology_config" file.
 """
 
 ###########
+# Optional parameters, overwritten by the config files if specified there
+PARSER_WORKERS = 1
+GRAPH_CACHE_LOCATION = ""
+LAZY_TERMINOLOGIES = "False"
+TERMINOLOGIES_MAX_LOADED = 0
+DATA_STREAMING = "False"
+FILTER_AT_PARSING = "False"
+COMPACT_GRAPHS = "False"
+COMPACT_TERMINOLOGIES_LOCATION = ""
+BASECODE_CACHE_SIZE = 100000
+URI_CACHE_SIZE = 100000
+ONTOLOGY_WORKERS = 1
+WRITE_BATCH_SIZE = 10000
+DATA_WORKERS = 1
+CONTEXT_CACHE_SIZE = 100000
+
 GRAPH_CONFIG = "/config/graph_config.json"
 I2B2_MAPPING = "/config/i2b2_rdf_config.json"
 DATA_CONFIG = "/config/data_config.json"
@@ -42,37 +67,176 @@ for key, val in config["data_global_uris"].items():
 
 
 SUBCLASS_PRED = rdflib.URIRef(SUBCLASS_PREDICATE_URI)
-TERMINOLOGIES_FILES = {}
+
+
+class TerminologyRegistry:
+    """
+    Dictionary-like holder of the dedicated terminology graphs, indexed by terminology file name (the values of TERMINOLOGIES_GRAPHS).
+    A terminology is either added as a loaded graph, or registered as a file only, in which case it is parsed the first time it is accessed.
+    If max_loaded is positive, the least recently used registered terminologies are freed when more than max_loaded graphs are in memory,
+    they are parsed again if accessed later.
+    Evicting a graph drops the indexes and memos built on it (see get_index), so they let it go.
+    Memory is only given back if nothing else still holds the graph, e.g the concepts of the tree being converted.
+    """
+
+    def __init__(self, max_loaded=0):
+        self.graphs = collections.OrderedDict()
+        self.sources = {}
+        self.max_loaded = int(max_loaded)
+
+    def register(self, name, filek, rdf_format):
+        self.sources[name] = (filek, rdf_format)
+
+    def update(self, dic):
+        for name, graph in dic.items():
+            self.graphs[name] = graph
+            self.graphs.move_to_end(name)
+
+    def keys(self):
+        return list(dict.fromkeys(list(self.graphs.keys()) + list(self.sources.keys())))
+
+    def __contains__(self, name):
+        return name in self.graphs or name in self.sources
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getitem__(self, name):
+        if name in self.graphs:
+            self.graphs.move_to_end(name)
+            return self.graphs[name]
+        filek, rdf_format = self.sources[name]
+        print("Loading terminology", name, "on first use")
+        graph = parse_graph_file(filek, rdf_format)
+        if COMPACT_GRAPHS == "True":
+            graph = compact_graph(graph)
+        self.graphs[name] = graph
+        self.evict()
+        return graph
+
+    def evict(self):
+        """
+        Free the least recently used terminologies that can be reloaded from their file, never the most recent one.
+        """
+        if self.max_loaded <= 0:
+            return
+        candidates = [name for name in list(self.graphs.keys())[:-1] if name in self.sources]
+        freed = False
+        for name in candidates:
+            if len(self.graphs) <= self.max_loaded:
+                break
+            print("Freeing terminology", name)
+            graph = self.graphs.pop(name)
+            drop_indexes(graph)
+            freed = True
+        if freed:
+            gc.collect()
+
+
+TERMINOLOGIES_FILES = TerminologyRegistry(TERMINOLOGIES_MAX_LOADED)
 
 
 class GraphParser:
-    def __init__(self, paths):
+    def __init__(self, paths, workers=None, triple_filter=None, compact=None):
+        """
+        Load every RDF file found under the given paths.
+        Files named after a terminology (see TERMINOLOGIES_GRAPHS) get a dedicated graph stored in TERMINOLOGIES_FILES, the other ones are merged in self.graph.
+        If LAZY_TERMINOLOGIES is set, terminology files are only registered and parsed the first time which_graph needs them.
+        If a TripleFilter is given, the triples it rejects are discarded while parsing the non-terminology files.
+        If more than one worker is requested (PARSER_WORKERS by default), the files are parsed in a process pool and merged afterwards in the same order as the serial run.
+        If compact is set (COMPACT_GRAPHS by default), the loaded graphs are turned into read-only graphs backed by a compactstore.CompactStore.
+        Those do not keep the parse order: output rows are the same but may come in another order, and instance numbers may differ.
+        Terminologies exported in COMPACT_TERMINOLOGIES_LOCATION (see scripts/compact_terminologies.py) are memory-mapped instead of parsed.
+        """
         self.graph = rdflib.Graph()
-        result = []
-        for pathi in paths:
-            if not os.path.exists(pathi):
-                continue
-            if os.path.isfile(pathi):
-                result.append(pathi)
-                continue
-            result.extend(glob.glob(pathi + "/**/*", recursive=True))
-        for filek in result:
+        self.compact = COMPACT_GRAPHS == "True" if compact is None else compact
+        workers = int(PARSER_WORKERS if workers is None else workers)
+        mapped = self.load_mapped_terminologies()
+        tasks = []
+        for filek in list_graph_files(paths):
             rdf_format = rdflib.util.guess_format(filek)
             if rdf_format is None or (RDF_FORMAT != "*" and rdf_format != RDF_FORMAT):
                 print("Couldn't parse file", filek, ", skipping")
                 continue
-            dot = filek.rfind(".")
-            slash = filek.rfind("/")
-            fname = filek[slash + 1 : dot]
+            fname = graph_name(filek)
+            if fname in mapped:
+                continue
+            if LAZY_TERMINOLOGIES == "True" and fname in TERMINOLOGIES_GRAPHS.values():
+                print("Registering", fname, "to be loaded on first use")
+                TERMINOLOGIES_FILES.register(fname, filek, rdf_format)
+                continue
+            tasks.append((filek, rdf_format, triple_filter))
+        if workers > 1 and len(tasks) > 1:
+            self.load_parallel(tasks, workers)
+        else:
+            self.load_serial(tasks)
+        if self.compact:
+            self.graph = compact_graph(self.graph)
+        print("Graph is fully loaded in memory.")
+
+    def load_mapped_terminologies(self):
+        """
+        Open the terminologies available as compact files, return their names.
+        A terminology already in TERMINOLOGIES_FILES (e.g. mapped by a previous parser of this process) is not mapped again.
+        """
+        if COMPACT_TERMINOLOGIES_LOCATION in ("", None, False):
+            return []
+        mapped = []
+        for fname in TERMINOLOGIES_GRAPHS.values():
+            path = compact_terminology_path(fname)
+            if fname in mapped or not os.path.isfile(path):
+                continue
+            if fname not in TERMINOLOGIES_FILES:
+                print("Mapping the compact graph of", fname)
+                TERMINOLOGIES_FILES.update({fname: load_compact_graph(path)})
+            mapped.append(fname)
+        return mapped
+
+    def load_serial(self, tasks):
+        for filek, rdf_format, triple_filter in tasks:
+            fname = graph_name(filek)
             if fname in TERMINOLOGIES_GRAPHS.values():
                 print("Creating a dedicated graph for", fname)
-                cur = rdflib.Graph()
-                cur.parse(filek, format=rdf_format)
-                TERMINOLOGIES_FILES.update({fname: cur})
+                graph = parse_graph_file(filek, rdf_format)
+                TERMINOLOGIES_FILES.update({fname: self.finish_terminology(graph)})
             else:
                 print("adding to the main graph: ", fname)
-                self.graph.parse(filek, format=rdf_format)
-        print("Graph is fully loaded in memory.")
+                parse_graph_file(filek, rdf_format, self.graph, triple_filter)
+
+    def load_parallel(self, tasks, workers):
+        """
+        Parse the files in a process pool. Workers send back plain triples and namespace bindings,
+        which are merged in the order of the file list so the resulting graphs are the same as with load_serial.
+        """
+        print("Parsing", len(tasks), "files using", workers, "workers")
+        # Terminologies get their own graph and are never filtered
+        tasks = [
+            (filek, rdf_format, None)
+            if graph_name(filek) in TERMINOLOGIES_GRAPHS.values()
+            else (filek, rdf_format, triple_filter)
+            for filek, rdf_format, triple_filter in tasks
+        ]
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            results = pool.imap(read_graph_file, tasks)
+            for (filek, rdf_format, _), (triples, namespaces) in zip(tasks, results):
+                fname = graph_name(filek)
+                if fname in TERMINOLOGIES_GRAPHS.values():
+                    print("Creating a dedicated graph for", fname)
+                    graph = rdflib.Graph()
+                    merge_triples(graph, triples, namespaces)
+                    TERMINOLOGIES_FILES.update({fname: self.finish_terminology(graph)})
+                else:
+                    print("adding to the main graph: ", fname)
+                    merge_triples(self.graph, triples, namespaces)
+
+    def finish_terminology(self, graph):
+        """
+        Compact a freshly loaded terminology graph right away if requested, so at most one of them is held in its full form at a time.
+        """
+        return compact_graph(graph) if self.compact else graph
 
     def define_namespaces(self):
         ns = [e for e in self.graph.namespace_manager.namespaces()]
@@ -86,6 +250,197 @@ class GraphParser:
         gc.collect()
 
 
+def list_graph_files(paths):
+    """
+    Expand the given list of files and directories into the list of files to be parsed.
+    Subdirectories are walked but not listed themselves, so each file comes once.
+    """
+    result = []
+    for pathi in paths:
+        if not os.path.exists(pathi):
+            continue
+        if os.path.isfile(pathi):
+            result.append(pathi)
+            continue
+        result.extend(
+            [k for k in glob.glob(pathi + "/**/*", recursive=True) if os.path.isfile(k)]
+        )
+    return result
+
+
+def graph_name(filek):
+    """
+    Return the file name stripped of its directory and extension, which is how terminologies are referenced in TERMINOLOGIES_GRAPHS.
+    """
+    dot = filek.rfind(".")
+    slash = filek.rfind("/")
+    return filek[slash + 1 : dot]
+
+
+def compact_terminology_path(fname, location=None):
+    """
+    Return where the compact file of a terminology is expected.
+    """
+    location = COMPACT_TERMINOLOGIES_LOCATION if location is None else location
+    return os.path.join(location, fname + ".rdfc")
+
+
+def merge_triples(graph, triples, namespaces):
+    """
+    Add a list of triples and namespace bindings (as returned by read_graph_file) to a graph.
+    """
+    for prefix, namespace in namespaces:
+        graph.bind(prefix, namespace)
+    graph.addN((s, p, o, graph) for s, p, o in triples)
+
+
+def parse_graph_file(filek, rdf_format, graph=None, triple_filter=None):
+    """
+    Parse a single RDF file in the given graph, or in a fresh one.
+    If the snapshot cache is enabled or a TripleFilter is given, go through read_graph_file instead of parsing directly.
+    """
+    graph = rdflib.Graph() if graph is None else graph
+    if GraphSnapshotCache().enabled() or triple_filter is not None:
+        merge_triples(graph, *read_graph_file((filek, rdf_format, triple_filter)))
+    else:
+        graph.parse(filek, format=rdf_format)
+    return graph
+
+
+def read_graph_file(task):
+    """
+    Return the triples and namespace bindings of a RDF file (filtered if a TripleFilter is given), from its snapshot if one exists.
+    Also the worker function of GraphParser.load_parallel: graphs do not travel well between processes, plain triples do.
+    """
+    filek, rdf_format, triple_filter = task
+    cache = GraphSnapshotCache()
+    snapshot = cache.load(filek, rdf_format, triple_filter)
+    if snapshot is not None:
+        return snapshot
+    graph = FilteredGraph(triple_filter)
+    graph.parse(filek, format=rdf_format)
+    graph.restore_path_ends()
+    # Triples in parse order: the graphs built from them are then the same as parsing the file directly, down to their iteration order
+    snapshot = (graph.parsed_triples(), list(graph.namespaces()))
+    cache.save(filek, rdf_format, snapshot, triple_filter)
+    return snapshot
+
+
+class TripleFilter:
+    """
+    Parse-time filter for data graphs, built from TO_IGNORE and BLACKLIST.
+    It rejects the triples whose predicate is ignored, which data_loader.is_valid would discard anyway after loading.
+    Predicates needed to resolve types, labels and context values (see COLUMNS_MAPPING) are always kept.
+    """
+
+    def __init__(self):
+        kept = set([TYPE_PREDICATE_URI, LABEL_PREDICATE_URI])
+        for el in COLUMNS_MAPPING["CONTEXT"].values():
+            for pred in el.get("pred_to_value", []) + el.get("verbose_value", []):
+                kept.add(rdflib.URIRef(pred))
+        self.path_end_predicates = frozenset([TYPE_PREDICATE_URI, LABEL_PREDICATE_URI])
+        self.predicates = frozenset(set(TO_IGNORE + BLACKLIST) - kept)
+        self.signature = hashlib.sha256(
+            "".join(sorted(self.predicates)).encode()
+        ).hexdigest()
+
+    def drops(self, triple):
+        return triple[1] in self.predicates
+
+
+class FilteredGraph(rdflib.Graph):
+    """
+    Graph in which the parser adds triples, silently discarding the ones rejected by a TripleFilter if one is given.
+    The kept triples are remembered in the order the parser adds them, which a plain list(graph) does not give (see parsed_triples).
+    A subject whose only forward links were discarded gets one of them back through restore_path_ends,
+    so the path end detection of data_loader.InformationTree behaves as on the unfiltered graph.
+    """
+
+    def __init__(self, triple_filter=None):
+        super().__init__()
+        self.triple_filter = triple_filter
+        self.dropped = {}
+        self.order = []
+
+    def add(self, triple):
+        if self.triple_filter is not None and self.triple_filter.drops(triple):
+            self.dropped.setdefault(triple[0], triple)
+            return self
+        self.order.append(triple)
+        return super().add(triple)
+
+    def restore_path_ends(self):
+        for subject, triple in self.dropped.items():
+            if all(
+                [
+                    pred in self.triple_filter.path_end_predicates
+                    for pred in self.predicates(subject)
+                ]
+            ):
+                self.order.append(triple)
+                super().add(triple)
+        self.dropped = {}
+
+    def parsed_triples(self):
+        """
+        Return the kept triples in the order they were added, each one once.
+        """
+        return list(dict.fromkeys(self.order))
+
+
+# Bumped whenever the content of a snapshot changes, so older snapshots are not read anymore
+SNAPSHOT_FORMAT = "2"
+
+
+class GraphSnapshotCache:
+    """
+    On-disk cache of parsed RDF files, located in GRAPH_CACHE_LOCATION (disabled if empty).
+    A snapshot is the pickled list of triples (in parse order) and namespaces of a file. It is keyed by the file content hash, the format and the rdflib version,
+    so a modified file or an upgraded rdflib simply misses the cache and gets parsed again.
+    """
+
+    def __init__(self, location=None):
+        self.location = GRAPH_CACHE_LOCATION if location is None else location
+
+    def enabled(self):
+        return self.location not in ("", None, False)
+
+    def snapshot_path(self, filek, rdf_format, triple_filter=None):
+        hasher = hashlib.sha256(
+            (SNAPSHOT_FORMAT + rdflib.__version__ + rdf_format).encode()
+        )
+        if triple_filter is not None:
+            hasher.update(triple_filter.signature.encode())
+        with open(filek, "rb") as ff:
+            for chunk in iter(lambda: ff.read(1 << 20), b""):
+                hasher.update(chunk)
+        return os.path.join(
+            self.location, graph_name(filek) + "-" + hasher.hexdigest()[:32] + ".pickle"
+        )
+
+    def load(self, filek, rdf_format, triple_filter=None):
+        if not self.enabled():
+            return None
+        path = self.snapshot_path(filek, rdf_format, triple_filter)
+        if not os.path.isfile(path):
+            return None
+        print("Loading snapshot of", filek)
+        with open(path, "rb") as ff:
+            return pickle.load(ff)
+
+    def save(self, filek, rdf_format, snapshot, triple_filter=None):
+        if not self.enabled():
+            return
+        create_dir(self.location)
+        path = self.snapshot_path(filek, rdf_format, triple_filter)
+        # Write then rename, so a concurrent or interrupted run never sees a partial snapshot
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "wb") as ff:
+            pickle.dump(snapshot, ff, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        print("Saved snapshot of", filek)
+
+
 class I2B2BasecodeHandler:
     """
     Compute and extract the basecode for a Class or a Property existing in the ontology.
@@ -99,7 +454,7 @@ class I2B2BasecodeHandler:
         if i2b2element is not None:
             self.core = i2b2element.component.get_uri()
             self.prefix = (
-                i2b2element.logical_parent.basecode_handler.get_basecode()
+                i2b2element.logical_parent.code
                 if i2b2element.logical_parent is not None
                 else ""
             )
@@ -117,14 +472,48 @@ class I2B2BasecodeHandler:
         and to be computable both from the ontology side and from the data loader side.
         The resulting code is the joining key between data tables and ontology tables.
         """
+        # The shared engine serves the configured settings, other ones are computed without cache
+        if (not debug) == (not BASECODES.debug) and cap == BASECODES.cap:
+            return BASECODES.code(rdf_uri, prefix)
+        return BasecodeEngine(debug=debug, cap=cap, cache_size=0).compute(rdf_uri, prefix)
+
+
+class BasecodeEngine:
+    """
+    Compute the basecodes described in I2B2BasecodeHandler.reduce_basecode, remembering the last cache_size ones.
+    The hash state of the recent prefixes is kept as well, so the codes sharing a prefix (the children of an element) only hash their own uri.
+    """
+
+    def __init__(self, debug=DEBUG, cap=MAX_BASECODE_LENGTH, cache_size=BASECODE_CACHE_SIZE):
+        self.debug = debug
+        self.cap = cap
+        self.code = functools.lru_cache(maxsize=int(cache_size))(self.compute)
+        self.prefix_state = functools.lru_cache(maxsize=int(cache_size))(self.hash_prefix)
+
+    @staticmethod
+    def hash_prefix(prefix):
+        return hashlib.sha256(prefix.encode())
+
+    def compute(self, rdf_uri, prefix=""):
         if type(rdf_uri) == rdflib.URIRef:
             rdf_uri = rdf_uri.toPython()
         if rdf_uri != "" and rdf_uri[-1] != "\\":
             rdf_uri = rdf_uri + "\\"
+        if self.debug:
+            return prefix + rdf_uri
+        # Hashing the prefix then the uri is the same as hashing their concatenation
+        state = self.prefix_state(prefix).copy()
+        state.update(rdf_uri.encode())
+        return state.hexdigest()[: self.cap]
+
+    def codes(self, rdf_uris, prefix=""):
+        """
+        Return the basecodes of several uris under the same prefix.
+        """
+        return [self.code(rdf_uri, prefix) for rdf_uri in rdf_uris]
 
-        to_hash = rdf_uri
-        to_hash = prefix + to_hash
-        return to_hash if debug else hashlib.sha256(to_hash.encode()).hexdigest()[:cap]
+
+BASECODES = BasecodeEngine()
 
 
 def rname(uri, graph):
@@ -137,17 +526,118 @@ def create_dir(relative_path):
     return os.makedirs(relative_path) if not os.path.exists(relative_path) else 0
 
 
+END_OF_CHILDREN = object()
+
+
+def traverse(roots, expand, leave=None):
+    """
+    Depth-first traversal on an explicit stack, so the depth of the explored trees is not bound by the recursion limit.
+    Yield the nodes, parents first. expand(node) is called right before node is yielded and returns an iterable over its children,
+    consumed lazily: a child is only reached once the subtree of its previous sibling has been visited.
+    If given, leave(node) is called once the whole subtree of node has been visited (post-order).
+    The stack only holds a (node, children iterator) pair per level of the current branch.
+    """
+    stack = [(None, iter(roots))]
+    while stack != []:
+        node, children = stack[-1]
+        child = next(children, END_OF_CHILDREN)
+        if child is END_OF_CHILDREN:
+            stack.pop()
+            # The bottom of the stack holds the roots, not a node
+            if leave is not None and stack != []:
+                leave(node)
+            continue
+        stack.append((child, iter(expand(child))))
+        yield child
+
+
+def visit(roots, expand, leave=None):
+    """
+    Run a traversal for its hooks only.
+    """
+    collections.deque(traverse(roots, expand, leave), maxlen=0)
+
+
+def get_index(graph, index_class):
+    """
+    Return the index of the given class for this graph, building it on first use.
+    Indexes are stored on the graph object, so they live exactly as long as the graph they describe.
+    """
+    indexes = graph.__dict__.setdefault("_converter_indexes", {})
+    if index_class not in indexes:
+        indexes[index_class] = index_class(graph)
+    return indexes[index_class]
+
+
+def drop_indexes(graph):
+    """
+    Forget the indexes built on a graph by get_index.
+    """
+    graph.__dict__.pop("_converter_indexes", None)
+
+
+class GraphMemo(dict):
+    """
+    Results computed on a graph, stored through get_index so they are freed along with the graph.
+    Subclassed once per kind of result, get_index keeping one memo per class.
+    """
+
+    def __init__(self, graph):
+        super().__init__()
+
+
+class PrefixTrie:
+    """
+    Character trie over a set of prefixes, finding the ones a string starts with in a single pass over the string.
+    """
+
+    def __init__(self, prefixes=()):
+        self.root = {}
+        for prefix in prefixes:
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            # The None key marks the end of a prefix
+            node[None] = prefix
+
+    def matches(self, string):
+        """
+        Return the prefixes of the string, shortest first.
+        """
+        res = []
+        node = self.root
+        for char in string:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                res.append(node[None])
+        return res
+
+
+TERMINOLOGIES_TRIE = PrefixTrie(TERMINOLOGIES_GRAPHS.keys())
+
+
+@functools.lru_cache(maxsize=int(URI_CACHE_SIZE))
+def terminology_keys(uri):
+    """
+    Return the TERMINOLOGIES_GRAPHS keys the uri starts with, in the config order.
+    """
+    matches = TERMINOLOGIES_TRIE.matches(uri)
+    return tuple([key for key in TERMINOLOGIES_GRAPHS.keys() if key in matches])
+
+
 def terminology_indicator(resource):
     """
     Determine if it is worth looking for properties of this concept or not.
     In the SPHN implementation, if the concept comes from a terminology (testable easily by looking at the URI) it doesn't have any properties
     """
-    return any([k in resource.identifier for k in TERMINOLOGIES_GRAPHS.keys()])
+    return terminology_keys(resource.identifier) != ()
 
 
 def which_graph(uri):
-    for key in TERMINOLOGIES_GRAPHS.keys():
-        if key in uri and TERMINOLOGIES_GRAPHS[key] in TERMINOLOGIES_FILES.keys():
+    for key in terminology_keys(uri):
+        if TERMINOLOGIES_GRAPHS[key] in TERMINOLOGIES_FILES:
             res = TERMINOLOGIES_FILES[TERMINOLOGIES_GRAPHS[key]]
             return res if res != "" and res is not None else False
     return False
@@ -163,22 +653,35 @@ def check_domains(resource):
         )
 
 
+class NamespaceIndex:
+    """
+    Prefix trie over the namespaces bound in a graph, used to reduce its uris. Built once the graph is loaded.
+    """
+
+    def __init__(self, graph):
+        self.namespace_manager = graph.namespace_manager
+        self.prefixes = {}
+        for key, value in self.namespace_manager.namespaces():
+            self.prefixes.setdefault(str(value), key)
+        self.trie = PrefixTrie(self.prefixes.keys())
+        self.shortname = functools.lru_cache(maxsize=int(URI_CACHE_SIZE))(self.reduce)
+
+    def reduce(self, uri):
+        shortname = self.namespace_manager.normalizeUri(uri)
+        if uri in shortname:
+            matches = self.trie.matches(uri)
+            if matches != []:
+                shortname = self.prefixes[matches[-1]] + ":" + uri[len(matches[-1]) :]
+        return shortname
+
+
 def shortname(resource):
     """
     Reduce the resource URI.
     In most cases the rdflib reasoner is able to do it, but in case it fails this method will do it explicitly.
     The protocol is finding the namespaces reduction that reduces the most the item and decide this is the prefix.
     """
-    shortname = resource.graph.namespace_manager.normalizeUri(resource.identifier)
-    uri = resource.identifier
-    if uri in shortname:
-        ns = resource.graph.namespace_manager.namespaces()
-        best_guess_len = 0
-        for key, value in ns:
-            if value in uri and len(value) > best_guess_len:
-                best_guess_len = len(value)
-                shortname = key + ":" + uri[len(value) :]
-    return shortname
+    return get_index(resource.graph, NamespaceIndex).shortname(resource.identifier)
 
 
 def format_date(rdfdate, generalize=True):
@@ -226,27 +729,57 @@ def from_csv(filename):
     return db.to_dict("records")
 
 
+class XMLTemplate:
+    """
+    XML pattern split once around its empty elements (<Tag></Tag>), which are the slots generate_xml can fill.
+    Filling the template is then a single join instead of one replace pass per value.
+    """
+
+    def __init__(self, pattern):
+        self.parts = []
+        self.slots = {}
+        pos = 0
+        for match in re.finditer(r"<([^<>/\s]+)></\1>", pattern):
+            self.parts.append(pattern[pos : match.start()])
+            self.slots.setdefault(match.group(1), []).append(len(self.parts))
+            self.parts.append(match.group(0))
+            pos = match.end()
+        self.parts.append(pattern[pos:])
+
+    def fill(self, values):
+        parts = list(self.parts)
+        for tag, val in values.items():
+            for idx in self.slots.get(tag, []):
+                parts[idx] = "<" + tag + ">" + val + "</" + tag + ">"
+        return "".join(parts)
+
+
+XML_TEMPLATE = XMLTemplate(XML_PATTERN)
+
+
 def generate_xml(metadata_dict):
     """
     Generate the metadata_xml panel for a specific entry. Uses the XML_PATTERN and UNITS_DIC global variables.
     enum types are not used since we have explicit valuesets as modifier leaves.
     Default type is string but PosFloat, Integer, PosInteger, Float are accepted
     """
-    keyz = metadata_dict.keys()
-    res = XML_PATTERN
-    for k in keyz:
-        ftag = "<" + k + ">"
-        etag = "</" + k + ">"
-        val = metadata_dict[k]
+    values = {}
+    for k, val in metadata_dict.items():
         if val is None:
             continue
         if k == "EnumValues":
-            enumstr = "".join(
-                ['<Val description="">' + elem + "</Val>" for elem in val]
-            )
-            val = enumstr
-        res = res.replace(ftag + etag, ftag + val + etag)
-    return res
+            val = "".join(['<Val description="">' + elem + "</Val>" for elem in val])
+        values[k] = val
+    return XML_TEMPLATE.fill(values)
+
+
+# The EQUIVALENCES entries with their XML already generated, shared read-only by all the value-bearing ontology elements
+COMPILED_EQUIVALENCES = {
+    key: types.MappingProxyType(
+        dict(cells, C_METADATAXML=generate_xml(cells["C_METADATAXML"]))
+    )
+    for key, cells in EQUIVALENCES.items()
+}
 
 
 def remove_duplicates(dics):
@@ -0,0 +1,86 @@
+import os
+import sys
+import pytest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + "/../src/")
+from utils import *
+import utils
+
+"""
+A small ontology and terminology written on disk by the tests, standing in for the SPHN files the tests of initsts need.
+"""
+
+TEST_ONTOLOGY = """
+@prefix sphn: <https://biomedit.ch/rdf/sphn-ontology/sphn#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix owl: <http://www.w3.org/2002/07/owl#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+@prefix snomed: <http://snomed.info/id/> .
+
+sphn:SPHNConcept a owl:Class ; rdfs:label "SPHN Concept" .
+sphn:LabResult a owl:Class ; rdfs:subClassOf sphn:SPHNConcept ; rdfs:label "Lab Result"@en, "Resultat labo"@fr ; rdfs:comment "a lab result" .
+sphn:FOPHDiagnosis a owl:Class ; rdfs:subClassOf sphn:SPHNConcept ; rdfs:label "FOPH Diagnosis" .
+sphn:Diagnosis a owl:Class ; rdfs:subClassOf sphn:SPHNConcept .
+sphn:SubDiag a owl:Class ; rdfs:subClassOf sphn:Diagnosis .
+sphn:Code a owl:Class ; rdfs:subClassOf sphn:SPHNConcept .
+sphn:Unit a owl:Class ; rdfs:subClassOf sphn:SPHNConcept .
+sphn:SubjectPseudoIdentifier a owl:Class ; rdfs:subClassOf sphn:SPHNConcept .
+sphn:ValueSet a owl:Class .
+sphn:Intent a owl:Class ; rdfs:subClassOf sphn:ValueSet .
+sphn:Curative a sphn:Intent , owl:NamedIndividual ; rdfs:label "curative" .
+sphn:Palliative a sphn:Intent , owl:NamedIndividual .
+
+sphn:hasCode a owl:ObjectProperty ; rdfs:label "has code" ;
+  rdfs:domain [ a owl:Class ; owl:unionOf ( sphn:LabResult sphn:FOPHDiagnosis sphn:SubDiag ) ] ;
+  rdfs:range [ a owl:Class ; owl:unionOf ( sphn:Code snomed:100 snomed:200 ) ] .
+sphn:hasFOPHDiagnosisCode a owl:ObjectProperty ; rdfs:subPropertyOf sphn:hasCode ;
+  rdfs:domain sphn:FOPHDiagnosis ; rdfs:range sphn:Code .
+sphn:hasLabResultValue a owl:DatatypeProperty ; rdfs:domain sphn:LabResult ; rdfs:range xsd:double .
+sphn:hasUnit a owl:ObjectProperty ; rdfs:domain sphn:LabResult ; rdfs:range sphn:Unit .
+sphn:hasUnitCode a owl:ObjectProperty ; rdfs:domain sphn:Unit ; rdfs:range sphn:Code .
+sphn:hasIntent a owl:ObjectProperty ; rdfs:domain sphn:FOPHDiagnosis ; rdfs:range sphn:Intent .
+sphn:hasSubjectPseudoIdentifier a owl:ObjectProperty ; rdfs:domain sphn:SPHNConcept ; rdfs:range sphn:SubjectPseudoIdentifier .
+sphn:hasIdentifier a owl:DatatypeProperty ; rdfs:domain sphn:SubjectPseudoIdentifier , sphn:Code ; rdfs:range xsd:string .
+sphn:hasDuration a owl:DatatypeProperty ; rdfs:domain sphn:LabResult ; rdfs:range xsd:double .
+sphn:hasDiagCode a owl:ObjectProperty ; rdfs:domain sphn:Diagnosis ; rdfs:range snomed:100 .
+"""
+TEST_TERMINOLOGY_URI = "http://snomed.info/id/"
+TEST_TERMINOLOGY = """
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix snomed: <http://snomed.info/id/> .
+snomed:100 rdfs:label "Root finding"@en , "Trouvaille"@fr .
+snomed:101 rdfs:subClassOf snomed:100 ; rdfs:label "child one"@en .
+snomed:102 rdfs:subClassOf snomed:100 ; rdfs:label "child two"@en ; rdfs:comment "c2" .
+snomed:103 rdfs:subClassOf snomed:101 ; rdfs:label "grandchild"@en .
+snomed:200 rdfs:label "Other root" .
+snomed:201 rdfs:subClassOf snomed:200 .
+"""
+SPHN = rdflib.Namespace("https://biomedit.ch/rdf/sphn-ontology/sphn#")
+TEST_URI = SPHN.FOPHDiagnosis
+
+
+@pytest.fixture
+def ontology_dirs(tmp_path, monkeypatch):
+    """
+    Write a small ontology and one of the configured terminologies, return their directories.
+    """
+    monkeypatch.setattr(utils, "RDF_FORMAT", "turtle")
+    main = tmp_path / "ontology"
+    terms = tmp_path / "terminologies"
+    main.mkdir()
+    terms.mkdir()
+    (main / "onto.ttl").write_text(TEST_ONTOLOGY)
+    terminology = TERMINOLOGIES_GRAPHS[TEST_TERMINOLOGY_URI]
+    (terms / (terminology + ".ttl")).write_text(TEST_TERMINOLOGY)
+    return [str(main), str(terms)]
+
+
+@pytest.fixture
+def ontology_graph(ontology_dirs):
+    """
+    Parse the test ontology and terminology like main_ontology does, return the ontology graph.
+    """
+    parser = GraphParser(ontology_dirs, workers=1)
+    parser.define_namespaces()
+    return parser.graph
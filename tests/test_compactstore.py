@@ -0,0 +1,79 @@
+import os
+import sys
+import pytest
+import itertools
+import rdflib
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + "/../src/")
+from compactstore import *
+
+EX = rdflib.Namespace("http://example.org/")
+TEST_TTL = """
+@prefix ex: <http://example.org/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix owl: <http://www.w3.org/2002/07/owl#> .
+ex:A a owl:Class ; rdfs:label "A"@en, "A fr"@fr ; rdfs:comment "first class" .
+ex:B rdfs:subClassOf ex:A ; rdfs:label "B" .
+ex:C rdfs:subClassOf ex:A .
+ex:hasX rdfs:domain [ a owl:Class ; owl:unionOf ( ex:A ex:B ) ] ; rdfs:range ex:C .
+ex:i1 a ex:B ; ex:hasValue 3 ; ex:hasX ex:i2 .
+ex:i2 a ex:C .
+"""
+
+
+def give_graphs():
+    graph = rdflib.Graph()
+    graph.parse(data=TEST_TTL, format="turtle")
+    return graph, compact_graph(graph)
+
+
+def test_patterns():
+    """
+    Check every triple pattern built from the graph terms gives the same answer on both stores.
+    """
+    graph, compact = give_graphs()
+    terms = set(itertools.chain.from_iterable(graph)) | {EX.absent}
+    choices = [None] + list(terms)
+    assert len(compact) == len(graph)
+    for s, p, o in itertools.product(choices, repeat=3):
+        assert sorted(compact.triples((s, p, o))) == sorted(graph.triples((s, p, o)))
+
+
+def test_resources_and_sparql():
+    graph, compact = give_graphs()
+    assert compact.resource(EX.B).value(rdflib.RDFS.subClassOf).identifier == EX.A
+    assert set(compact.resource(EX.A).subjects(rdflib.RDFS.subClassOf)) == set(
+        [compact.resource(EX.B), compact.resource(EX.C)]
+    )
+    query = """
+        SELECT ?p WHERE {
+            ?p rdfs:domain [ a owl:Class ; owl:unionOf [ rdf:rest*/rdf:first ?self ] ]
+        }
+    """
+    res = [k[0] for k in compact.query(query, initBindings={"self": EX.B})]
+    assert res == [EX.hasX]
+    assert compact.qname(EX.A) == "ex:A"
+
+
+def test_readonly():
+    graph, compact = give_graphs()
+    with pytest.raises(Exception):
+        compact.add((EX.A, EX.B, EX.C))
+
+
+def test_mapped_file(tmp_path):
+    """
+    Check a graph written to a compact file answers the same patterns once memory-mapped.
+    """
+    graph, _ = give_graphs()
+    graph.add((EX.A, EX.note, rdflib.Literal("with\x00nul and é", lang="fr")))
+    path = str(tmp_path / "test.rdfc")
+    dump_compact(graph, path)
+    mapped = load_compact_graph(path)
+    terms = set(itertools.chain.from_iterable(graph)) | {EX.absent}
+    choices = [None] + list(terms)
+    assert set(mapped) == set(graph)
+    for s, p, o in itertools.product(choices, repeat=3):
+        assert sorted(mapped.triples((s, p, o))) == sorted(graph.triples((s, p, o)))
+    assert dict(mapped.namespaces())["ex"] == rdflib.URIRef(EX)
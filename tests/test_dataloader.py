@@ -5,11 +5,13 @@ import random
 import string
 
 herePath = os.path.dirname(os.path.abspath(__file__))
-sys.path.insert(0, herePath)
+sys.path.insert(0, herePath + "/../src/")
 
-from initsts import *
 from utils import from_csv
 from data_loader import *
+import data_loader
+import main_data
+import utils
 
 TEST_CLASS_URI = "https://biomedit.ch/rdf/sphn-ontology/sphn#LabResult"
 
@@ -27,6 +29,42 @@ TEST_TERMINOLOGY_END = [
 TEST_NONENDS_OBJECTS = ["https://biomedit.ch/rdf/sphn-resource/" + k for k in []]
 TEST_PREDICATES = []
 
+SPHN = rdflib.Namespace("https://biomedit.ch/rdf/sphn-ontology/sphn#")
+TEST_ENTRY_CLASSES = [SPHN.LabResult, SPHN.FOPHDiagnosis]
+TEST_PREFIXES = """
+@prefix sphn: <https://biomedit.ch/rdf/sphn-ontology/sphn#> .
+@prefix res: <https://biomedit.ch/rdf/sphn-resource/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+@prefix snomed: <http://snomed.info/id/> .
+"""
+# Data partitions, one of them in a subdirectory, and the context graph they share
+TEST_DATA_FILES = {
+    "data/d1.ttl": """
+res:lab1 a sphn:LabResult ; sphn:hasSubjectPseudoIdentifier res:pat1 ; sphn:hasAdministrativeCase res:case1 ;
+    sphn:hasLabResultValue "3.5"^^xsd:double ; sphn:hasUnit res:unit-mg ; sphn:hasCode res:code1 ;
+    sphn:hasDateTime "2020-03-04T10:11:12"^^xsd:dateTime .
+res:lab2 a sphn:LabResult ; sphn:hasSubjectPseudoIdentifier res:pat2 ; sphn:hasLabResultValue "4.5"^^xsd:double ; sphn:hasUnit res:unit-mg .
+res:lab4 a sphn:LabResult ; sphn:hasSubjectPseudoIdentifier res:pat1 ; sphn:hasLabResultValue "1"^^xsd:double ; sphn:hasUnit res:unit-mg .
+res:pat1 a sphn:SubjectPseudoIdentifier ; sphn:hasIdentifier "P1" .
+res:pat2 a sphn:SubjectPseudoIdentifier ; sphn:hasIdentifier "P2" .
+res:case1 a sphn:AdministrativeCase ; sphn:hasIdentifier "E1" .
+res:code1 a snomed:101 ; sphn:hasCodeName "child one" .
+""",
+    "data/sub/d2.ttl": """
+res:diag1 a sphn:FOPHDiagnosis ; sphn:hasSubjectPseudoIdentifier res:pat3 ; sphn:hasAdministrativeCase res:case2 ;
+    sphn:hasIntent sphn:Curative ; sphn:hasDuration "2.0"^^xsd:double .
+res:lab3 a sphn:LabResult ; sphn:hasSubjectPseudoIdentifier res:pat3 ; sphn:hasAdministrativeCase res:case2 ;
+    sphn:hasLabResultValue "7"^^xsd:double ; sphn:hasUnit res:unit-mg .
+res:pat3 a sphn:SubjectPseudoIdentifier ; sphn:hasIdentifier "P3" .
+res:case2 a sphn:AdministrativeCase ; sphn:hasIdentifier "E2" .
+""",
+    "units/units.ttl": """
+res:unit-mg a sphn:Unit ; sphn:hasUnitCode res:ucode-mg .
+res:ucode-mg rdfs:label "mg" .
+""",
+}
+
 
 class test_dataloaderclass:
     def __init__(self):
@@ -92,3 +130,188 @@ class test_dataloaderclass:
 
     def test_valuereplacement():
         pass
+
+
+@pytest.fixture
+def data_dirs(tmp_path, monkeypatch):
+    """
+    Write the test data and context graphs, return the data and context directories.
+    """
+    monkeypatch.setattr(utils, "RDF_FORMAT", "turtle")
+    for name, content in TEST_DATA_FILES.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(TEST_PREFIXES + content)
+    return str(tmp_path / "data"), str(tmp_path / "units")
+
+
+@pytest.fixture
+def data_parser(data_dirs):
+    return GraphParser(paths=list(data_dirs))
+
+
+def read_lines(filename):
+    with open(filename) as ff:
+        return ff.read().splitlines()
+
+
+def test_split_instances(data_parser):
+    """
+    Check sub-batches cover the instances in order, numbered after the instances of previous partitions.
+    """
+    dl = DataLoader(data_parser, [])
+    observations = list(range(2 * MAX_BATCH_SIZE + 1))
+    sub_batches = dl.split_instances(observations, 5)
+    assert [start for _, start in sub_batches] == [
+        6,
+        MAX_BATCH_SIZE + 6,
+        2 * MAX_BATCH_SIZE + 6,
+    ]
+    assert sum([sub for sub, _ in sub_batches], []) == observations
+
+
+def test_parallel_extraction(data_parser, tmp_path, monkeypatch):
+    """
+    Check DATA_WORKERS=1 and DATA_WORKERS=2 write the same OBSERVATION_FACT file, several sub-batches per class included.
+    """
+    monkeypatch.setattr(data_loader, "MAX_BATCH_SIZE", 2)
+    outputs = []
+    for workers in (1, 2):
+        monkeypatch.setattr(data_loader, "DATA_WORKERS", workers)
+        filename = str(tmp_path / ("OBSERVATION_FACT_" + str(workers) + ".csv"))
+        dl = DataLoader(
+            data_parser, data_parser.get_entrypoints(TEST_ENTRY_CLASSES), filename
+        )
+        dl.extract_all()
+        outputs.append(read_lines(filename))
+    assert len(outputs[0]) > len(TEST_ENTRY_CLASSES) + 1
+    assert outputs[0] == outputs[1]
+
+
+def test_type_index(data_parser):
+    """
+    Check the type index gives the instances the per-class query returns, in the same order.
+    """
+    index = TypeIndex(data_parser.graph, TEST_ENTRY_CLASSES)
+    assert index.counts() == {SPHN.LabResult: 4, SPHN.FOPHDiagnosis: 1}
+    for cls in TEST_ENTRY_CLASSES:
+        query = data_parser.graph.query(
+            "select ?obs where { ?obs rdf:type ?class }", initBindings={"class": cls}
+        )
+        assert index.instances(cls) == [k[0] for k in query]
+
+
+def test_adjacency_index(data_parser):
+    """
+    Check the adjacency view gives the pairs and type the Resource wrappers return.
+    """
+    graph = data_parser.graph
+    adjacency = AdjacencyIndex(graph)
+    for subject in graph.subjects(unique=True):
+        resource = graph.resource(subject)
+        assert adjacency.pairs(subject) == list(graph.predicate_objects(subject))
+        rdftype = resource.value(TYPE_PREDICATE_URI)
+        assert adjacency.rdftype(subject) == (
+            rdftype.identifier if rdftype is not None else None
+        )
+
+
+def test_context_resolver(data_parser):
+    """
+    Check context values are resolved once and then reused.
+    """
+    resolver = ContextResolver(data_parser.graph)
+    adjacency = resolver.adjacency
+    elements = [
+        (adjacency.rdftype(subject).toPython(), subject)
+        for subject in data_parser.graph.subjects(unique=True)
+        if adjacency.rdftype(subject) is not None
+        and adjacency.rdftype(subject).toPython() in CONTEXT_FIELDS.keys()
+    ]
+    assert elements != []
+    for obj_type, subject in elements:
+        assert resolver.value(obj_type, subject) == resolver.resolve(obj_type, subject)
+        resolver.value(obj_type, subject)
+    assert resolver.value.cache_info().hits == len(elements)
+
+
+def test_value_converters():
+    """
+    Check the compiled value converters fill the cells their COLUMNS_MAPPING entries describe.
+    """
+    date = datetime.date(2021, 5, 3)
+    for vtype, item in COLUMNS_MAPPING["VALUE"].items():
+        details = {}
+        VALUE_CONVERTERS[vtype].apply(details, date)
+        expected = {
+            item["col"]: extract_value(date, item["transform"])
+            if "transform" in item.keys()
+            else date
+        }
+        expected.update(item["misc"])
+        assert details == expected
+
+
+def test_streaming_extraction(data_dirs, tmp_path, monkeypatch):
+    """
+    Check streaming the data partitions (one of them in a subdirectory) writes the same OBSERVATION_FACT rows as loading the whole data graph,
+    instance and encounter numbers included.
+    """
+    data, units = data_dirs
+    monkeypatch.setattr(main_data, "DATA_GRAPHS_LOCATION", data)
+    monkeypatch.setattr(main_data, "CONTEXT_GRAPHS_LOCATION", units)
+    monkeypatch.setattr(main_data, "ENTRY_DATA_CONCEPTS", TEST_ENTRY_CLASSES)
+    outputs = []
+    loaders = [
+        ("whole", main_data.load_observations),
+        ("streamed", main_data.stream_observations),
+    ]
+    for name, load in loaders:
+        output_dir = tmp_path / name
+        output_dir.mkdir()
+        monkeypatch.setattr(main_data, "OUTPUT_TABLES_LOCATION", str(output_dir) + "/")
+        load()
+        outputs.append(read_lines(str(output_dir / "OBSERVATION_FACT.csv")))
+    whole, streamed = outputs
+    assert len(whole) > len(TEST_ENTRY_CLASSES) + 1
+    assert any([line.startswith("E2,P3,") for line in whole])
+    assert whole[0] == streamed[0]
+    assert sorted(whole[1:]) == sorted(streamed[1:])
+
+
+def test_parse_filter(data_dirs):
+    """
+    Check the parse-time filter drops the blacklisted predicates and keeps the ones the context values are read from.
+    """
+    unfiltered = GraphParser(paths=list(data_dirs)).graph
+    filtered = GraphParser(paths=list(data_dirs), triple_filter=TripleFilter()).graph
+    assert len(filtered) < len(unfiltered)
+    for pred in BLACKLIST:
+        assert len(list(unfiltered.triples((None, pred, None)))) > 0
+        assert list(filtered.triples((None, pred, None))) == []
+    for pred in [SPHN.hasIdentifier, SPHN.hasCodeName]:
+        assert len(list(filtered.triples((None, pred, None)))) > 0
+        assert set(filtered.triples((None, pred, None))) == set(
+            unfiltered.triples((None, pred, None))
+        )
+
+
+def test_filtered_extraction(data_dirs, tmp_path, monkeypatch):
+    """
+    Check filtering at parsing writes the same OBSERVATION_FACT rows as the unfiltered run.
+    """
+    data, units = data_dirs
+    monkeypatch.setattr(main_data, "DATA_GRAPHS_LOCATION", data)
+    monkeypatch.setattr(main_data, "CONTEXT_GRAPHS_LOCATION", units)
+    monkeypatch.setattr(main_data, "ENTRY_DATA_CONCEPTS", TEST_ENTRY_CLASSES)
+    outputs = []
+    for flag in ("False", "True"):
+        output_dir = tmp_path / ("filter_" + flag)
+        output_dir.mkdir()
+        monkeypatch.setattr(main_data, "FILTER_AT_PARSING", flag)
+        monkeypatch.setattr(main_data, "OUTPUT_TABLES_LOCATION", str(output_dir) + "/")
+        main_data.load_observations()
+        outputs.append(read_lines(str(output_dir / "OBSERVATION_FACT.csv")))
+    unfiltered, filtered = outputs
+    assert len(unfiltered) > len(TEST_ENTRY_CLASSES) + 1
+    assert filtered == unfiltered
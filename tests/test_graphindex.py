@@ -0,0 +1,127 @@
+import os
+import sys
+import pytest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath)
+sys.path.insert(0, myPath + "/../src/")
+from sample_ontology import *
+from graphindex import *
+from compactstore import dump_compact
+
+
+def ontology_classes(graph):
+    return [
+        k
+        for k in set(graph.subjects(rdflib.RDF.type, rdflib.OWL.Class))
+        if type(k) == rdflib.URIRef
+    ]
+
+
+def test_domain_index(ontology_graph):
+    """
+    Check the domain index gives the same properties as the SPARQL query it replaces, for every class of the ontology.
+    """
+    index = get_index(ontology_graph, DomainIndex)
+    for cls in ontology_classes(ontology_graph):
+        response = ontology_graph.query(
+            """
+            SELECT ?p
+            WHERE {
+                {
+                ?p rdfs:domain ?self
+                }
+                UNION
+                {
+                ?p rdfs:domain [ a owl:Class ;
+                                    owl:unionOf [ rdf:rest*/rdf:first ?self ]
+                                ]
+                }
+                FILTER NOT EXISTS {
+                    ?child rdfs:subPropertyOf+ ?p .
+                    {
+                    ?child rdfs:domain ?self
+                    }
+                    UNION
+                    {
+                    ?child rdfs:domain [ a owl:Class ;
+                                        owl:unionOf [ rdf:rest*/rdf:first ?self ]
+                                    ]
+                    }
+                }
+            }
+            """,
+            initBindings={"self": cls},
+        )
+        assert sorted([row[0] for row in response]) == sorted(index.properties(cls))
+    assert index.properties(SPHN.FOPHDiagnosis) != []
+
+
+def test_subclass_index(ontology_graph):
+    """
+    Check the subclass index lists the same children as the graph, in the same order.
+    """
+    index = get_index(ontology_graph, SubclassIndex)
+    for cls in ontology_classes(ontology_graph):
+        assert index.children(cls) == list(ontology_graph.subjects(SUBCLASS_PRED, cls))
+    assert index.children(SPHN.SPHNConcept) != []
+
+
+def test_label_index():
+    """
+    Check the preferred label follows the language, then the order in which the subject lists its labels.
+    """
+    graph = rdflib.Graph()
+    first = rdflib.URIRef("http://example.org/first")
+    second = rdflib.URIRef("http://example.org/second")
+    graph.add((second, rdflib.RDFS.label, rdflib.Literal("deux", lang="xx")))
+    graph.add((first, rdflib.RDFS.label, rdflib.Literal("un", lang="yy")))
+    graph.add((first, rdflib.RDFS.label, rdflib.Literal("deux", lang="xx")))
+    graph.add((first, COMMENT_PREDICATE_URI, rdflib.Literal("comment")))
+    index = get_index(graph, LabelIndex)
+    assert index.preferred_label(first, "xx") == "deux"
+    assert index.preferred_label(first, "zz") == "un"
+    assert index.preferred_label(rdflib.URIRef("http://example.org/none"), "xx") == ""
+    assert index.comment(first) == "comment"
+    assert index.comment(second) is None
+
+
+@pytest.fixture
+def mapped_terminology(tmp_path):
+    """
+    Write the test terminology as a compact file, return it parsed and mapped.
+    """
+    graph = rdflib.Graph().parse(data=TEST_TERMINOLOGY, format="turtle")
+    path = str(tmp_path / "terminology.rdfc")
+    dump_compact(graph, path)
+    return graph, load_compact_graph(path)
+
+
+def test_label_index_mapped(mapped_terminology):
+    """
+    Check labels and comments are looked up on a mapped graph instead of collected, with the same results.
+    """
+    graph, mapped = mapped_terminology
+    index = get_index(graph, LabelIndex)
+    mapped_index = get_index(mapped, LabelIndex)
+    assert is_mapped(mapped) and not is_mapped(graph)
+    assert not hasattr(mapped_index, "labels") and not hasattr(mapped_index, "comments")
+    for subject in set(graph.subjects()):
+        for language in ("en", "fr", "xx"):
+            assert mapped_index.preferred_label(subject, language) == index.preferred_label(
+                subject, language
+            )
+        assert mapped_index.comment(subject) == index.comment(subject)
+
+
+def test_subclass_index_mapped(mapped_terminology):
+    """
+    Check subclasses are looked up on a mapped graph instead of collected, with the same results.
+    """
+    graph, mapped = mapped_terminology
+    index = get_index(graph, SubclassIndex)
+    mapped_index = get_index(mapped, SubclassIndex)
+    assert not hasattr(mapped_index, "index")
+    for cls in set(graph.subjects()) | set(graph.objects(None, SUBCLASS_PRED)):
+        assert sorted(mapped_index.children(cls)) == sorted(index.children(cls))
+    assert mapped_index.children(rdflib.URIRef(TEST_TERMINOLOGY_URI + "100")) != []
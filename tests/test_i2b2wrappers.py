@@ -31,7 +31,7 @@ def test_converterclass():
         )
     )
     converter = I2B2Converter(root_rdfconcept)
-    all_concepts = converter.i2b2voidconcepts + converter.left_tosearch
+    all_concepts = list(converter.iter_i2b2concepts())
     assert len(all_concepts) > 0 and not all(
         [conc.level == all_concepts[0].level for conc in all_concepts]
     )
@@ -0,0 +1,173 @@
+import os
+import sys
+import pytest
+from rdflib.collection import Collection
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath)
+sys.path.insert(0, myPath + "/../src/")
+from sample_ontology import *
+from i2b2wrappers import *
+import i2b2wrappers
+
+
+def construct_property(graph, uri):
+    pf = PropertyFilter(None)
+    pf.resources = [graph.resource(rdflib.URIRef(uri))]
+    properties = pf.get_properties()
+    for k in properties:
+        k.digin_ranges()
+    return properties
+
+
+def test_range_index_several_ranges():
+    """
+    Check properties with several plain ranges keep all of them, and union ranges are expanded without the blank node itself.
+    """
+    graph = rdflib.Graph()
+    first = rdflib.URIRef("http://example.org/First")
+    second = rdflib.URIRef("http://example.org/Second")
+    plain = rdflib.URIRef("http://example.org/plain")
+    graph.add((plain, RANGE_PREDICATE_URI, first))
+    graph.add((plain, RANGE_PREDICATE_URI, second))
+    union = rdflib.BNode()
+    members = rdflib.BNode()
+    other = rdflib.URIRef("http://example.org/other")
+    graph.add((other, RANGE_PREDICATE_URI, union))
+    graph.add((union, rdflib.RDF.type, rdflib.OWL.Class))
+    graph.add((union, rdflib.OWL.unionOf, members))
+    Collection(graph, members, [first, second])
+
+    expected = [graph.resource(first), graph.resource(second)]
+    assert sorted(RangeFilter(graph.resource(plain)).extract_range_type()) == expected
+    assert RangeFilter(graph.resource(other)).extract_range_type() == expected
+
+
+def test_expand_range_once(ontology_graph):
+    """
+    Check a range reached through several properties is explored once and shared.
+    """
+    res = ontology_graph.resource(SPHN.Code)
+    first = expand_range(res, Concept)
+    assert expand_range(res, Concept) is first
+    assert expand_range(res, ChildfreeConcept) is not first
+
+
+def test_expand_range_per_graph(ontology_dirs, ontology_graph):
+    """
+    Check the expanded ranges are kept on the graph they come from, so a graph loaded later gets its own components.
+    """
+    first = expand_range(ontology_graph.resource(SPHN.Code), Concept)
+    other_graph = GraphParser(ontology_dirs, workers=1).graph
+    other = expand_range(other_graph.resource(SPHN.Code), Concept)
+    assert other is not first
+    assert other[0].resource.graph is other_graph
+    # Terminology ranges are kept on the terminology graph, and freed with it
+    term_graph = TERMINOLOGIES_FILES[TERMINOLOGIES_GRAPHS[TEST_TERMINOLOGY_URI]]
+    term_uri = rdflib.URIRef(TEST_TERMINOLOGY_URI + "100")
+    term = expand_range(ontology_graph.resource(term_uri), Concept)
+    assert term[0].resource.graph is term_graph
+    assert (term_uri, Concept) in get_index(term_graph, ExpandedRanges)
+
+
+def test_parallel_batches(ontology_graph):
+    """
+    Check the forked conversion yields the same lines as the serial one.
+    """
+
+    def give_converter():
+        return I2B2Converter(Concept(ontology_graph.resource(SPHN.SPHNConcept)))
+
+    serial = []
+    converter = give_converter()
+    while converter.get_batch():
+        serial.extend(converter.towrite)
+    parallel = []
+    converter = give_converter()
+    for buffer in converter.get_parallel_batches(2):
+        parallel.extend(converter.towrite)
+    assert len(serial) > 1
+    assert serial == parallel
+
+
+def test_write_batches(ontology_graph, monkeypatch):
+    """
+    Check get_batch cuts the lines in batches of WRITE_BATCH_SIZE, given as a string in the config.
+    """
+    monkeypatch.setattr(i2b2wrappers, "WRITE_BATCH_SIZE", "2")
+    converter = I2B2Converter(Concept(ontology_graph.resource(SPHN.SPHNConcept)))
+    batches = []
+    while converter.get_batch():
+        batches.append(converter.towrite)
+    assert len(batches) > 1
+    assert all([len(batch) == 2 for batch in batches[:-1]])
+    assert sum(batches, []) == list(
+        I2B2Converter(Concept(ontology_graph.resource(SPHN.SPHNConcept))).iter_lines()
+    )
+
+
+def test_streamed_modifiers(ontology_graph):
+    """
+    Check the modifiers are yielded with their display information complete, parents before children.
+    """
+    prop = construct_property(ontology_graph, SPHN.hasCode)
+    conc = I2B2Concept(Concept(ontology_graph.resource(TEST_URI)))
+    i2b2mod = I2B2Modifier(prop[0], parent=conc, applied_path=conc.path)
+    lines = []
+    seen_paths = [i2b2mod.path]
+    for modifier in i2b2mod.iter_mtree():
+        assert modifier.parent is None or modifier.parent.path in seen_paths
+        seen_paths.append(modifier.path)
+        lines.append(modifier.get_db_line())
+    assert lines != []
+    assert lines == [k.get_db_line() for k in i2b2mod.walk_mtree()]
+
+
+def test_slotted_elements(ontology_graph):
+    """
+    Check graph components and i2b2 elements carry no instance dictionary, and their handlers still give the stored path and code.
+    """
+    concept = Concept(ontology_graph.resource(TEST_URI))
+    elem = I2B2Concept(concept)
+    assert not hasattr(concept, "__dict__") and not hasattr(elem, "__dict__")
+    assert elem.path_handler.get_path() == elem.path
+    assert elem.basecode_handler.get_basecode() == elem.code
+
+
+def test_drop_decisions(ontology_graph):
+    """
+    Check the memoized drop decisions match a scan of the attribute children.
+    """
+    concept = Concept(ontology_graph.resource(SPHN.LabResult))
+    concept.explore_children()
+    decisions = []
+    for attr in concept.get_children(verbose=False):
+        dropped = [
+            rn.get_uri()
+            for rn in attr.get_children(verbose=False)
+            if rn.get_uri() in ONTOLOGY_DROP_DIC
+        ]
+        decisions.append(drop(attr))
+        assert drop(attr) == (dropped[0] if dropped != [] else False)
+        assert drop(attr) == drop(attr)
+    assert any(decisions) and not all(decisions)
+    for droppy, parents in UNDROP_LEAVES.items():
+        assert all([save_from_drop(droppy, parent) for parent in parents])
+
+
+def test_drop_decisions_per_graph(ontology_graph, tmp_path):
+    """
+    Check the drop decisions taken on a graph do not carry over to another graph loaded in the same process.
+    """
+    other_dir = tmp_path / "other"
+    other_dir.mkdir()
+    (other_dir / "onto.ttl").write_text(
+        TEST_ONTOLOGY.replace("rdfs:range sphn:Unit", "rdfs:range sphn:Code")
+    )
+    other_graph = GraphParser([str(other_dir)], workers=1).graph
+    decisions = []
+    for graph in (ontology_graph, other_graph):
+        prop = construct_property(graph, SPHN.hasUnit)[0]
+        decisions.append(drop(prop))
+        assert prop.resource.graph is graph
+    assert decisions == [str(SPHN.Unit), False]
@@ -0,0 +1,333 @@
+import gc
+import os
+import sys
+import weakref
+import pytest
+import rdflib
+from rdflib.compare import isomorphic
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath)
+sys.path.insert(0, myPath + "/../src/")
+from sample_ontology import *
+from utils import *
+import utils
+import rdfwrappers
+import main_ontology
+from compactstore import dump_compact
+
+
+def write_metadata(ontology_dirs, output_dir, monkeypatch):
+    """
+    Run the ontology conversion on the test ontology, return the lines of METADATA.csv.
+    """
+    os.makedirs(output_dir)
+    monkeypatch.setattr(main_ontology, "ONTOLOGY_GRAPHS_LOCATIONS", ontology_dirs)
+    monkeypatch.setattr(main_ontology, "OUTPUT_TABLES_LOCATION", output_dir + "/")
+    main_ontology.generate_ontology_table()
+    with open(output_dir + "/METADATA.csv") as ff:
+        return ff.read().splitlines()
+
+
+def test_parallel_parse(ontology_dirs):
+    """
+    Check the graphs parsed by a pool of workers hold the same triples as the serial parse.
+    """
+    terminology = TERMINOLOGIES_GRAPHS[TEST_TERMINOLOGY_URI]
+    serial = GraphParser(ontology_dirs, workers=1)
+    serial_terminology = TERMINOLOGIES_FILES[terminology]
+    parallel = GraphParser(ontology_dirs, workers=2)
+    assert len(serial.graph) > 0
+    assert isomorphic(serial.graph, parallel.graph)
+    assert set(serial_terminology) == set(TERMINOLOGIES_FILES[terminology])
+
+
+def test_parallel_parse_metadata(ontology_dirs, tmp_path, monkeypatch):
+    """
+    Check the METADATA table is the same, row order included, whether the graphs are parsed serially or by a pool of workers.
+    """
+    outputs = []
+    for workers in (1, 2):
+        monkeypatch.setattr(utils, "PARSER_WORKERS", workers)
+        output_dir = str(tmp_path / ("output_" + str(workers)))
+        outputs.append(write_metadata(ontology_dirs, output_dir, monkeypatch))
+    assert len(outputs[0]) > 1
+    assert outputs[0] == outputs[1]
+
+
+def test_ontology_workers_metadata(ontology_dirs, tmp_path, monkeypatch):
+    """
+    Check the METADATA table is the same whether the concepts are converted serially or by a pool of workers, the count being given as a string.
+    """
+    outputs = []
+    for workers in (1, "2"):
+        monkeypatch.setattr(main_ontology, "ONTOLOGY_WORKERS", workers)
+        output_dir = str(tmp_path / ("output_" + str(workers)))
+        outputs.append(write_metadata(ontology_dirs, output_dir, monkeypatch))
+    assert len(outputs[0]) > 1
+    assert outputs[0] == outputs[1]
+
+
+TEST_DATA = """
+@prefix sphn: <https://biomedit.ch/rdf/sphn-ontology/sphn#> .
+@prefix res: <https://biomedit.ch/rdf/sphn-resource/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+@prefix snomed: <http://snomed.info/id/> .
+res:lab1 a sphn:LabResult ; sphn:hasSubjectPseudoIdentifier res:pat1 ; sphn:hasLabResultValue "3.5"^^xsd:double ;
+    sphn:hasUnit res:unit-mg ; sphn:hasCode res:code1 ; sphn:hasDateTime "2020-03-04T10:11:12"^^xsd:dateTime .
+res:lab2 a sphn:LabResult ; sphn:hasSubjectPseudoIdentifier res:pat2 ; sphn:hasLabResultValue "4.5"^^xsd:double ; sphn:hasUnit res:unit-mg .
+res:pat1 a sphn:SubjectPseudoIdentifier ; sphn:hasIdentifier "P1" .
+res:pat2 a sphn:SubjectPseudoIdentifier ; sphn:hasIdentifier "P2" .
+res:code1 a snomed:101 ; sphn:hasCodeName "child one" .
+res:unit-mg a sphn:Unit ; sphn:hasUnitCode res:ucode-mg .
+res:ucode-mg rdfs:label "mg" .
+"""
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / "data.ttl"
+    path.write_text(TEST_DATA)
+    return str(path)
+
+
+@pytest.fixture
+def parsed_files(monkeypatch):
+    """
+    Record the files actually parsed by read_graph_file.
+    """
+    parsed = []
+    parse = FilteredGraph.parse
+
+    def recording_parse(self, source, **kwargs):
+        parsed.append(source)
+        return parse(self, source, **kwargs)
+
+    monkeypatch.setattr(FilteredGraph, "parse", recording_parse)
+    return parsed
+
+
+@pytest.fixture
+def snapshot_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "GRAPH_CACHE_LOCATION", str(tmp_path / "cache"))
+    return GraphSnapshotCache()
+
+
+def triples_in_order(graph):
+    """
+    Return the triples of every subject (sorted) in the order the graph gives them.
+    """
+    return [
+        (s, p, o)
+        for s in sorted(set(graph.subjects()))
+        for p, o in graph.predicate_objects(s)
+    ]
+
+
+def test_snapshot_hit(data_file, snapshot_cache, parsed_files):
+    """
+    Check a file is parsed once, then read from its snapshot, giving the same graph as a direct parse.
+    """
+    assert snapshot_cache.enabled()
+    first = read_graph_file((data_file, "turtle", None))
+    assert parsed_files == [data_file]
+    assert os.path.isfile(snapshot_cache.snapshot_path(data_file, "turtle"))
+    second = read_graph_file((data_file, "turtle", None))
+    assert parsed_files == [data_file]
+    assert second == first
+    direct = rdflib.Graph()
+    direct.parse(data_file, format="turtle")
+    cached = parse_graph_file(data_file, "turtle")
+    assert parsed_files == [data_file]
+    assert set(cached) == set(direct)
+    assert triples_in_order(cached) == triples_in_order(direct)
+
+
+def test_snapshot_invalidation(data_file, snapshot_cache, parsed_files, monkeypatch):
+    """
+    Check a snapshot is not used anymore once the file content, the rdflib version or the TripleFilter changes.
+    """
+    read_graph_file((data_file, "turtle", None))
+    assert len(parsed_files) == 1
+    with open(data_file, "a") as ff:
+        ff.write('res:pat3 a sphn:SubjectPseudoIdentifier ; sphn:hasIdentifier "P3" .\n')
+    triples, _ = read_graph_file((data_file, "turtle", None))
+    assert len(parsed_files) == 2
+    assert len(triples) == len(rdflib.Graph().parse(data_file, format="turtle"))
+    monkeypatch.setattr(rdflib, "__version__", "0.0.0")
+    read_graph_file((data_file, "turtle", None))
+    assert len(parsed_files) == 3
+    triple_filter = TripleFilter()
+    read_graph_file((data_file, "turtle", triple_filter))
+    assert len(parsed_files) == 4
+    read_graph_file((data_file, "turtle", triple_filter))
+    assert len(parsed_files) == 4
+    triple_filter.signature = "another filter"
+    read_graph_file((data_file, "turtle", triple_filter))
+    assert len(parsed_files) == 5
+
+
+# Outside of the configured terminologies, so components stay on the graph they are built from
+TEST_TERMS_URI = "http://example.org/terms/"
+
+
+@pytest.fixture
+def terminology_files(tmp_path):
+    """
+    Write two small terminologies, return their paths by name.
+    """
+    paths = {}
+    for name in ("terms_a", "terms_b"):
+        path = tmp_path / (name + ".ttl")
+        path.write_text(TEST_TERMINOLOGY.replace(TEST_TERMINOLOGY_URI, TEST_TERMS_URI))
+        paths[name] = str(path)
+    return paths
+
+
+def test_lazy_terminologies(ontology_dirs, monkeypatch):
+    """
+    Check LAZY_TERMINOLOGIES registers the terminology files, and a terminology is parsed the first time it is accessed only.
+    """
+    registry = TerminologyRegistry()
+    monkeypatch.setattr(utils, "TERMINOLOGIES_FILES", registry)
+    monkeypatch.setattr(utils, "LAZY_TERMINOLOGIES", "True")
+    GraphParser(ontology_dirs, workers=1)
+    terminology = TERMINOLOGIES_GRAPHS[TEST_TERMINOLOGY_URI]
+    assert terminology in registry
+    assert terminology not in registry.graphs
+    graph = registry[terminology]
+    assert len(graph) == len(rdflib.Graph().parse(data=TEST_TERMINOLOGY, format="turtle"))
+    assert registry[terminology] is graph
+
+
+def test_terminology_eviction(terminology_files):
+    """
+    Check the least recently used terminology is freed past max_loaded, along with the caches built on it, and parsed again when needed.
+    """
+    registry = TerminologyRegistry(max_loaded=1)
+    for name, path in terminology_files.items():
+        registry.register(name, path, "turtle")
+    graph_a = registry["terms_a"]
+    triples_a = set(graph_a)
+    get_index(graph_a, NamespaceIndex)
+    uri = rdflib.URIRef(TEST_TERMS_URI + "100")
+    rdfwrappers.expand_range(graph_a.resource(uri), rdfwrappers.Concept)
+    assert rdfwrappers.ExpandedRanges in graph_a.__dict__["_converter_indexes"]
+    registry["terms_b"]
+    assert list(registry.graphs.keys()) == ["terms_b"]
+    assert "_converter_indexes" not in graph_a.__dict__
+    freed = weakref.ref(graph_a)
+    del graph_a
+    gc.collect()
+    assert freed() is None
+    reloaded = registry["terms_a"]
+    assert set(reloaded) == triples_a
+    assert list(registry.graphs.keys()) == ["terms_a"]
+
+
+def test_mapped_terminologies_once(ontology_dirs, tmp_path, monkeypatch):
+    """
+    Check a compact terminology is memory-mapped by the first parser only, and is not parsed by the next ones.
+    """
+    compact_dir = tmp_path / "compact"
+    compact_dir.mkdir()
+    terminology = TERMINOLOGIES_GRAPHS[TEST_TERMINOLOGY_URI]
+    dump_compact(
+        rdflib.Graph().parse(data=TEST_TERMINOLOGY, format="turtle"),
+        compact_terminology_path(terminology, str(compact_dir)),
+    )
+    registry = TerminologyRegistry()
+    monkeypatch.setattr(utils, "TERMINOLOGIES_FILES", registry)
+    monkeypatch.setattr(utils, "COMPACT_TERMINOLOGIES_LOCATION", str(compact_dir))
+    loaded = []
+
+    def load(path):
+        loaded.append(path)
+        return load_compact_graph(path)
+
+    monkeypatch.setattr(utils, "load_compact_graph", load)
+    GraphParser(ontology_dirs, workers=1)
+    graph = registry[terminology]
+    GraphParser(ontology_dirs, workers=1)
+    assert len(loaded) == 1
+    assert registry[terminology] is graph
+
+
+def test_traverse():
+    """
+    Check the traversal engine visits parents first, calls the post-order hook after the subtree, and is not bound by the recursion limit.
+    """
+    tree = {0: [1, 4], 1: [2, 3], 4: [5]}
+    left = []
+    assert list(traverse([0], lambda k: tree.get(k, []), leave=left.append)) == [0, 1, 2, 3, 4, 5]
+    assert left == [2, 3, 1, 5, 4, 0]
+    depth = sys.getrecursionlimit() * 2
+    chain = traverse([0], lambda k: [k + 1] if k < depth else [])
+    assert sum(1 for k in chain) == depth + 1
+
+
+def test_prefix_matching(ontology_graph):
+    """
+    Check terminology detection and shortnames agree with scanning all the terminology keys and namespaces.
+    """
+    namespaces = list(ontology_graph.namespace_manager.namespaces())
+    uris = set(
+        [k for triple in ontology_graph for k in triple if type(k) == rdflib.URIRef]
+    )
+    assert any([terminology_indicator(ontology_graph.resource(uri)) for uri in uris])
+    for uri in uris:
+        resource = ontology_graph.resource(uri)
+        assert terminology_indicator(resource) == any(
+            [uri.startswith(k) for k in TERMINOLOGIES_GRAPHS.keys()]
+        )
+        expected = ontology_graph.namespace_manager.normalizeUri(uri)
+        if uri in expected:
+            best_guess_len = 0
+            for key, value in namespaces:
+                if uri.startswith(value) and len(value) > best_guess_len:
+                    best_guess_len = len(value)
+                    expected = key + ":" + uri[len(value) :]
+        assert shortname(resource) == expected
+
+
+def test_metadataxml():
+    """
+    Check the XML template fills the empty elements of XML_PATTERN like successive replacements would.
+    """
+    values = {"DataType": "Float", "EnumValues": ["a", "b"], "TestID": None}
+    expected = XML_PATTERN.replace("<DataType></DataType>", "<DataType>Float</DataType>")
+    expected = expected.replace(
+        "<EnumValues></EnumValues>",
+        '<EnumValues><Val description="">a</Val><Val description="">b</Val></EnumValues>',
+    )
+    assert generate_xml(values) == expected
+    for key, cells in EQUIVALENCES.items():
+        compiled = COMPILED_EQUIVALENCES[key]
+        assert compiled["C_METADATAXML"] == generate_xml(cells["C_METADATAXML"])
+        with pytest.raises(TypeError):
+            compiled["VALUETYPE_CD"] = ""
+
+
+def test_basecode_engine():
+    """
+    Check the cached engine gives the same codes as hashing the joined prefix and uri, in normal and debug modes.
+    """
+    uri = rdflib.URIRef(TEST_URI)
+    for prefix in ["", "abc", "\\sphn:SPHNConcept\\"]:
+        expected = hashlib.sha256((prefix + str(uri) + "\\").encode()).hexdigest()
+        engine = BasecodeEngine(debug=False, cap=MAX_BASECODE_LENGTH)
+        assert engine.code(uri, prefix) == expected[:MAX_BASECODE_LENGTH]
+        assert engine.codes([uri, uri], prefix) == [expected[:MAX_BASECODE_LENGTH]] * 2
+        assert BasecodeEngine(debug="True").code(uri, prefix) == prefix + str(uri) + "\\"
+
+
+def test_uri_cache_size(ontology_graph, monkeypatch):
+    """
+    Check the shortname cache accepts a size given as a string in the config.
+    """
+    monkeypatch.setattr(utils, "URI_CACHE_SIZE", "10")
+    index = NamespaceIndex(ontology_graph)
+    uri = rdflib.URIRef(TEST_URI)
+    assert index.shortname(uri) == shortname(ontology_graph.resource(uri))
+    assert index.shortname.cache_info().maxsize == 10